@@ -1,66 +1,135 @@
 # Check whether the currently installed packages are the ones specified
 # in the `requirements.txt` file.
 #
-# Exit with code 1 if any of the three is true:
+# Exit with code 1 if either of these is true:
 #   - At least one of the currently installed packages has a different
 #       version than the one specified in `requirements.txt`.
 #   - At least one of the packages in `requirements.txt` is not currently installed.
-#   - There is at leas a packages installed that is not in the `requirements.txt`.
+#
+# Packages installed that are not in `requirements.txt` are listed but don't
+# cause a failure: `run_dev.sh` installs optional packages (fastpbkdf2, deflate, pysqlite3-binary, the AI
+# plugin requirements and their dependencies) on top of `requirements.txt`.
 #
 
+import os
 import sys
-import importlib.metadata
-from typing import Dict
+from typing import Dict, Optional, Tuple
 
 # Quick lookup of currently installed packages and their versions
 current_packages: Dict[str, str] = {}
 
+_UNDERSCORE_TO_DASH = str.maketrans('_', '-')
+
 def normalize_name(name: str) -> str:
-    return name.strip().replace('_', '-').lower()
+    return name.strip().translate(_UNDERSCORE_TO_DASH).lower()
 
 def normalize_version(version: str) -> str:
     return version.strip().lower()
 
-def check_package(req: str) -> bool:
-    " Does 'req' (requirements.txt line) match the currently installed packages? "
-    # Get the package name and the version
-    if ';' in req:
-        req = req.split(';')[0].strip()
+def read_pkg_info_version(pathname: str) -> Optional[str]:
+    " Return the Version header of an .egg-info directory (or file), or None if there isn't one. "
+    if os.path.isdir(pathname):
+        pathname = os.path.join(pathname, 'PKG-INFO')
+
+    try:
+        with open(pathname, encoding='utf-8') as pkg_info:
+            for line in pkg_info:
+                if line.startswith('Version:'):
+                    return line[len('Version:'):]
+                if not line.strip():
+                    # End of the headers.
+                    break
+    except OSError:
+        pass
+
+    return None
+
+def find_installed_packages() -> Dict[str, str]:
+    """
+    Return {name: version} for every distribution on sys.path.
+
+    Names and versions are taken from the metadata directory names (name-version.dist-info) rather than
+    via importlib.metadata, which reads and parses the METADATA file of every distribution. Only
+    .egg-info directories without a version in their name need to be opened.
+    """
+    packages: Dict[str, str] = {}
+
+    for path_entry in sys.path:
+        try:
+            entries = os.scandir(path_entry or '.')
+        except OSError:
+            # Nonexistent directories, zip files, etc.
+            continue
+
+        with entries:
+            for entry in entries:
+                stem, _, suffix = entry.name.rpartition('.')
+                version: Optional[str]
+
+                if suffix == 'dist-info':
+                    # name-version.dist-info: neither part may contain a hyphen.
+                    name, _, version = stem.rpartition('-')
+                elif suffix == 'egg-info':
+                    # name-version-pyX.Y.egg-info, or just name.egg-info for development installs.
+                    name, _, version = stem.partition('-')
+                    version = version.partition('-')[0] or read_pkg_info_version(entry.path)
+                else:
+                    continue
+
+                if not name or not version:
+                    continue
+
+                # The first distribution found on sys.path wins, as it does for imports.
+                # (normalize_name() and normalize_version() inlined: this runs for every distribution.)
+                packages.setdefault(name.strip().translate(_UNDERSCORE_TO_DASH).lower(), version.strip().lower())
+
+    return packages
+
+def parse_requirement(req: str) -> Tuple[str, Optional[str]]:
+    " Return (name, version) for 'req' (a requirements.txt line). version is None for editable installs. "
+    # Drop any environment marker.
+    req = req.partition(';')[0].strip()
 
-    version = None  # shut linter up
     if req.startswith('-e'):
         # Editable. Just check package name without version.
-        if 'egg=' in req:
-            project_name = req.split('#egg=')[1]
-            check_version = False
-        else:
-            project_name = req.split('/')[-1]
-            check_version = False
-    else:
-        basics_without_constraints = req.split(';')[0]
-        project_name, version = basics_without_constraints.strip().split('==')
-        check_version = True
-
-    project_name = normalize_name(project_name)
-    version = normalize_version(version)
-
-    if project_name not in current_packages:
-        return False
-    
-    if check_version and current_packages[project_name] != version:
-        return False
-
-    return True
+        if '#egg=' in req:
+            return normalize_name(req.split('#egg=')[1]), None
+
+        return normalize_name(req.split('/')[-1]), None
+
+    project_name, version = req.split('==')
+    return normalize_name(project_name), normalize_version(version)
+
+def read_requirements(pathname: str) -> Dict[str, Optional[str]]:
+    " Parse the requirements file once into {name: version} "
+    with open(pathname) as requirements:
+        return dict(
+            parse_requirement(line)
+            for line in map(str.strip, requirements)
+            if line and not line.startswith('#')
+        )
 
 def main():
-    for dist in importlib.metadata.distributions():
-        current_packages[normalize_name(dist.name)] = normalize_version(dist.version)
+    current_packages.update(find_installed_packages())
+    required = read_requirements('requirements.txt')
+
+    missing = sorted(required.keys() - current_packages.keys())
+    mismatched = sorted(
+        name for name, version in required.items()
+        if version is not None and name in current_packages and current_packages[name] != version
+    )
+    extra = sorted(current_packages.keys() - required.keys())
+
+    for name in missing:
+        print(f'Requirements do not match for {name}: not installed')
+    for name in mismatched:
+        print(f'Requirements do not match for {name}: installed {current_packages[name]}, '
+              f'required {required[name]}')
+    for name in extra:
+        print(f'Installed but not in requirements.txt: {name}=={current_packages[name]}')
 
-    with open('requirements.txt') as requirements:
-        for req in requirements:
-            if not check_package(req.strip()):
-                print(f'Requirements do not match for {req}')
-                sys.exit(1)
+    if missing or mismatched:
+        sys.exit(1)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
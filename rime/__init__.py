@@ -3,5 +3,4 @@
 # Copyright 2023 Telemarq Ltd
 
 from .rime import Rime
-import graphql
 from .rimeserver import create_app as rimeserver_create_app
@@ -58,18 +58,23 @@ def get_rime_config():
     rime_base = get_rime_base()
     rime_config = os.path.join(rime_base, 'rime_settings.yaml')
 
-    if not os.path.exists(rime_config):
-        # Create a default config file.
-        config_vars = {
-            'filesystem_base': os.path.join(rime_base, 'example'),
-            'metadata_base': os.path.join(rime_base, 'metadata'),
-            'session_pathname': os.path.join(rime_base, 'rime_session.db'),
-        }
-        with open(rime_config, 'w') as h:
-            h.write(CONFIG_TEMPLATE.format(**config_vars))
-
-        os.makedirs(config_vars['filesystem_base'], exist_ok=True)
-        os.makedirs(config_vars['metadata_base'], exist_ok=True)
+    try:
+        h = open(rime_config, 'x')
+    except FileExistsError:
+        # Already configured.
+        return rime_config
+
+    # First run: create a default config file.
+    config_vars = {
+        'filesystem_base': os.path.join(rime_base, 'example'),
+        'metadata_base': os.path.join(rime_base, 'metadata'),
+        'session_pathname': os.path.join(rime_base, 'rime_session.db'),
+    }
+    with h:
+        h.write(CONFIG_TEMPLATE.format(**config_vars))
+
+    os.makedirs(config_vars['filesystem_base'], exist_ok=True)
+    os.makedirs(config_vars['metadata_base'], exist_ok=True)
 
     return rime_config
 
@@ -78,7 +83,12 @@ def main():
     env = os.environ.copy()
     env['RIME_CONFIG'] = get_rime_config()
 
-    subprocess.run(CMDLINE, env=env)
+    if sys.platform == 'win32':
+        # exec on Windows starts a new process and exits this one, which confuses the console.
+        subprocess.run(CMDLINE, env=env)
+    else:
+        # Replace this process with the server rather than keeping a second Python waiting for it.
+        os.execvpe(CMDLINE[0], CMDLINE, env)
 
 
 main()
@@ -3,15 +3,35 @@
 # Copyright 2023 Telemarq Ltd
 from typing import Optional
 import os
+import shutil
+import stat
 import tempfile
+import threading
 import zipfile
 
 import fs.osfs
+import fs.zipfs
 
 from .base import DeviceFilesystem
-from .devicesettings import DeviceSettings
+from .devicesettings import DeviceSettings, DEVICE_SETTINGS_FILENAME
+from .ensuredir import ensuredir
 from .fslibfilesystem import FSLibFilesystem
 from . import zipsupport
+from ..sql import sqlite3_connect_filename as sqlite3_connect_with_regex_support
+
+# Files which may accompany an SQLite database and must be alongside it when it's opened.
+SQLITE3_JOURNAL_SUFFIXES = ('-journal', '-wal', '-shm')
+
+
+def _bind_passthrough_methods(obj, target, names):
+    """
+    Set obj.<name> to target.<name> for each name.
+
+    The classes below still define these methods, as DeviceFilesystem requires, but calls through the instance
+    attribute go straight to 'target' without an extra Python frame for the pass-through.
+    """
+    for name in names:
+        setattr(obj, name, getattr(target, name))
 
 
 class AndroidDeviceFilesystem(DeviceFilesystem):
@@ -20,9 +40,17 @@ class AndroidDeviceFilesystem(DeviceFilesystem):
         self._settings = DeviceSettings(root)
         self._fsaccess = FSLibFilesystem(fs.osfs.OSFS(root), metadata_db_path)
 
+        _bind_passthrough_methods(self, self._fsaccess, (
+            'dirname', 'basename', 'stat', 'scandir', 'walk', 'walk_batched', 'exists', 'getsize', 'open', 'syspath',
+            'create_file', 'sqlite3_connect', 'sqlite3_create', 'get_dir_entry'))
+
     @classmethod
     def is_device_filesystem(cls, path):
-        return os.path.exists(os.path.join(path, 'data', 'data', 'android'))
+        try:
+            return stat.S_ISDIR(os.stat(os.path.join(path, 'data', 'data', 'android')).st_mode)
+        except OSError:
+            # Including NotADirectoryError when 'path' is a file, such as a zipped filesystem.
+            return False
 
     @classmethod
     def create(cls, id_: str, root: str, metadata_db_path: str, template: Optional[DeviceFilesystem] = None)\
@@ -56,6 +84,12 @@ class AndroidDeviceFilesystem(DeviceFilesystem):
     def scandir(self, path):
         return self._fsaccess.scandir(path)
 
+    def walk(self, path):
+        return self._fsaccess.walk(path)
+
+    def walk_batched(self, path, batch_size=256):
+        return self._fsaccess.walk_batched(path, batch_size)
+
     def exists(self, path):
         return self._fsaccess.exists(path)
 
@@ -65,6 +99,9 @@ class AndroidDeviceFilesystem(DeviceFilesystem):
     def open(self, path):
         return self._fsaccess.open(path)
 
+    def syspath(self, path):
+        return self._fsaccess.syspath(path)
+
     def create_file(self, path):
         return self._fsaccess.create_file(path)
 
@@ -96,36 +133,91 @@ class AndroidZippedDeviceFilesystem(DeviceFilesystem):
     Zipped filesystem of an Android device. Currently supports only read mode
     for the data.
 
-    The contents of the .zip file are extracted in a temporary directory
-    and then the (only) directory from within the temporary directory
-    (the `main_dir`) is used to instantiate a filesystem. All queries
-    refer to the data in the temporary directory.
+    The .zip file is read in place: the (only) directory within it (the
+    `main_dir`) is used to instantiate a filesystem. Files which must be on
+    disk, such as SQLite databases and the RIME settings database, are
+    extracted to a temporary directory the first time they are needed.
     """
 
+    # Maps the real path of a zip file to its modification time and size, and the name of its main directory, so
+    # that __init__ doesn't have to scan a zip that is_device_filesystem() has just scanned. A zip which is replaced
+    # overwrites its entry, so there is one per path.
+    _main_dir_cache: dict[str, tuple[tuple, str]] = {}
+
     def __init__(self, id_: str, root: str, metadata_db_path: str):
         self.id_ = id_
 
-        # extract the files from the zipfile in a temporary directory
+        main_dir_name = self._cached_main_dir_name(root)
+        if main_dir_name is None:
+            with zipfile.ZipFile(root) as zp:
+                main_dir_name = zipsupport.get_zipfile_main_dir(zp).name
+
+        # instantiate a filesystem from the main directory within the zip file
+        self._zipfs = fs.zipfs.ZipFS(root)
+        self._fs = self._zipfs.opendir(main_dir_name)
+        self._fsaccess = FSLibFilesystem(self._fs, metadata_db_path)
+
+        _bind_passthrough_methods(self, self._fsaccess, ('dirname', 'basename', 'stat', 'scandir', 'get_dir_entry'))
+        _bind_passthrough_methods(self, self._fs, ('exists', 'getsize'))
+
+        # files extracted on demand, mapping path within main_dir to extracted pathname
         self.temp_root = tempfile.TemporaryDirectory()
+        self._extracted = {}
+        self._extract_lock = threading.Lock()
 
-        with zipfile.ZipFile(root) as zp:
-            main_dir = zipsupport.get_zipfile_main_dir(zp)
-            zp.extractall(path=self.temp_root.name)
+        self._extract_if_exists(DEVICE_SETTINGS_FILENAME)
+        self._settings = DeviceSettings(self.temp_root.name)
 
-        # instantiate a filesystem from the temporary directory
-        self._fs = fs.osfs.OSFS(os.path.join(self.temp_root.name, main_dir.name))
-        self._settings = DeviceSettings(os.path.join(self.temp_root.name, main_dir.name))
-        self._fsaccess = FSLibFilesystem(self._fs, metadata_db_path)
+    def _extract(self, path):
+        """
+        Extract 'path' from the zip file, if we haven't already, and return its pathname on disk.
+        """
+        with self._extract_lock:
+            if path not in self._extracted:
+                syspath = os.path.join(self.temp_root.name, *path.strip('/').split('/'))
+                ensuredir(syspath)
+
+                with self._fs.open(path, 'rb') as src, open(syspath, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+
+                self._extracted[path] = syspath
+
+            return self._extracted[path]
+
+    def _extract_if_exists(self, path):
+        if self._fs.exists(path):
+            return self._extract(path)
+
+        return None
+
+    @staticmethod
+    def _zip_identity(path):
+        stat_val = os.stat(path)
+        return (stat_val.st_mtime_ns, stat_val.st_size)
+
+    @classmethod
+    def _cached_main_dir_name(cls, path):
+        """
+        Return the main directory name is_device_filesystem() found in the zip at 'path', or None if the zip has
+        changed since or wasn't looked at.
+        """
+        identity, main_dir_name = cls._main_dir_cache.get(os.path.realpath(path), (None, None))
+        return main_dir_name if identity == cls._zip_identity(path) else None
 
     @classmethod
     def is_device_filesystem(cls, path):
-        if not zipfile.is_zipfile(path):
+        try:
+            with zipfile.ZipFile(path) as zp:
+                # get the main directory contained in the .zip container file
+                main_dir = zipsupport.get_zipfile_main_dir(zp)
+                if not (main_dir / 'data' / 'data' / 'android').exists():
+                    return False
+        except (zipfile.BadZipFile, OSError, ValueError):
+            # Not a zip file, or not one with a main directory.
             return False
 
-        with zipfile.ZipFile(path) as zp:
-            # get the main directory contained in the .zip container file
-            main_dir = zipsupport.get_zipfile_main_dir(zp)
-            return (main_dir / 'data' / 'data' / 'android').exists()
+        cls._main_dir_cache[os.path.realpath(path)] = (cls._zip_identity(path), main_dir.name)
+        return True
 
     @classmethod
     def create(cls, id_: str, root: str, metadata_db_path: str, template: Optional['DeviceFilesystem'] = None)\
@@ -151,7 +243,12 @@ class AndroidZippedDeviceFilesystem(DeviceFilesystem):
         raise NotImplementedError
 
     def sqlite3_connect(self, path, read_only=True):
-        return self._fsaccess.sqlite3_connect(path, read_only)
+        # SQLite needs a real file, so extract the database along with any journal files.
+        syspath = self._extract(path)
+        for suffix in SQLITE3_JOURNAL_SUFFIXES:
+            self._extract_if_exists(path + suffix)
+
+        return sqlite3_connect_with_regex_support(syspath, read_only=read_only)
 
     def sqlite3_create(self, path):
         raise NotImplementedError
@@ -13,13 +13,63 @@ if TYPE_CHECKING:
     from ..sql import Connection
 
 
-@dataclass(frozen=True, unsafe_hash=True)
+def walk_depth_first(scandir, path):
+    """
+    Yield a DirEntry for every non-directory below 'path', depth first, listing directories with 'scandir'.
+
+    Uses a stack of directory iterators rather than recursion, so deep trees don't hit the recursion limit.
+    """
+    stack = [iter(scandir(path))]
+    while stack:
+        for entry in stack[-1]:
+            if entry.is_dir():
+                stack.append(iter(scandir(entry.path)))
+                break
+
+            yield entry
+        else:
+            stack.pop()
+
+
+def walk_batched_depth_first(scandir, path, batch_size):
+    """
+    Yield lists of DirEntries for the non-directories below 'path', listing directories with 'scandir'.
+
+    Each list holds the files of one or more whole directories, so is at least 'batch_size' long except for the
+    last. Directories are visited depth first, but each directory's files come before those of its subdirectories.
+    """
+    batch = []
+    stack = [path]
+    while stack:
+        subdirs = []
+        for entry in scandir(stack.pop()):
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            else:
+                batch.append(entry)
+
+        # Reversed so that the first subdirectory is visited next.
+        stack.extend(reversed(subdirs))
+
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+@dataclass(frozen=True)
 class File:
     """
     """
     pathname: str
     mime_type: Optional[str] = None
 
+    def __hash__(self):
+        # Equal Files have equal pathnames, and str caches its hash.
+        return hash(self.pathname)
+
 
 class DeviceFilesystem(ABC):
     """
@@ -94,6 +144,12 @@ class DeviceFilesystem(ABC):
         """
         return None
 
+    def syspath(self, path) -> Optional[str]:
+        """
+        Return the pathname of 'path' on the host filesystem, or None if it isn't stored there as a plain file.
+        """
+        return None
+
     @abstractmethod
     def create_file(self, path):
         """
@@ -130,11 +186,18 @@ class DeviceFilesystem(ABC):
         return False
 
     def walk(self, path):
-        for entry in self.scandir(path):
-            if entry.is_dir():
-                yield from self.walk(entry.path)
-            else:
-                yield entry
+        """
+        Yield a DirEntry for every non-directory below 'path', depth first.
+        """
+        return walk_depth_first(self.scandir, path)
+
+    def walk_batched(self, path, batch_size=256):
+        """
+        As walk(), but yield lists of DirEntries, for callers which process files in bulk.
+
+        Files are not yielded in the same order as walk().
+        """
+        return walk_batched_depth_first(self.scandir, path, batch_size)
 
     @abstractmethod
     def dirname(self, pathname):
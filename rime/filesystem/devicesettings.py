@@ -2,9 +2,11 @@ from contextlib import contextmanager
 import posixpath
 from ..sql import sqlite3_connect as sqlite3_connect_with_regex_support
 
+DEVICE_SETTINGS_FILENAME = '_rime_settings.db'
+
 
 class DeviceSettings:
-    def __init__(self, path, settings_filename='_rime_settings.db'):
+    def __init__(self, path, settings_filename=DEVICE_SETTINGS_FILENAME):
         self._db_name = posixpath.join(path, settings_filename)
         self._init_tables()
 
@@ -3,7 +3,7 @@ import mimetypes
 import os
 import stat
 
-from filetype import guess as filetype_guess
+from filetype import guess as filetype_guess, types as filetype_types
 
 # MIME type for DirEntries which haven't yet had their MIME type determined
 MIME_TYPE_NOT_YET_DETERMINED = 'rime/mime-type-not-yet-determined'
@@ -18,44 +18,204 @@ MIME_TYPE_DIRECTORY = 'inode/directory'
 # Just kidding, chosen by reference to https://github.com/h2non/filetype.py
 FILE_HEADER_GUESS_LENGTH = 261
 
+# Extensions whose MIME type we take from the file name without reading the file: common media and database
+# formats. The MIME types come from filetype, so they match what sniffing a correctly-named file would give.
+_TRUSTED_EXTENSIONS = {'jpg', 'png', 'gif', 'webp', 'heic', 'mp3', 'm4a', 'amr', '3gp', 'mp4', 'mov', 'webm', 'pdf',
+                       'sqlite'}
+_TRUSTED_EXTENSION_MIME_TYPES = {
+    matcher.extension: matcher.mime
+    for matcher in filetype_types
+    if matcher.extension in _TRUSTED_EXTENSIONS
+}
+_TRUSTED_EXTENSION_MIME_TYPES['jpeg'] = _TRUSTED_EXTENSION_MIME_TYPES['jpg']
 
-@dataclass(eq=True, frozen=True)
+# The mimetypes database, loaded now rather than on the first guess and keyed by lower-case extension without the
+# dot. Used when a file's contents don't identify it. Anything else is left to mimetypes.guess_type(): extensions
+# which it maps onto others (e.g. .tgz) or treats as an encoding (e.g. the .gz of .tar.gz), and the few mixed-case
+# extensions in the database, which it matches differently between Python versions.
+mimetypes.init()
+_GUESS_TYPE_SUFFIXES = {suffix.lower() for suffix in (*mimetypes.suffix_map, *mimetypes.encodings_map)}
+_MIMETYPES_BY_EXTENSION = {
+    extension[1:]: mime_type
+    for extension, mime_type in mimetypes.types_map.items()
+    if extension == extension.lower() and extension not in _GUESS_TYPE_SUFFIXES
+}
+
+# Magic numbers of the commonest sniffed formats, looked up by a file's first bytes before falling back to filetype,
+# which tries each of its matchers in turn. Each maps to the filetype extension it identifies and the shortest
+# header filetype accepts. No earlier filetype matcher can claim a file by any of these magic numbers, but some
+# look elsewhere in the header, so files which have one of _FILETYPE_MARKERS are always left to filetype.
+_MAGIC_NUMBERS = {
+    b'\xff\xd8\xff': ('jpg', 3),
+    b'GIF': ('gif', 3),
+    b'ID3': ('mp3', 3),
+    b'SQLi': ('sqlite', 4),
+    b'%PDF': ('pdf', 4),
+    b'OggS': ('ogg', 4),
+    b'fLaC': ('flac', 4),
+    b'#!AMR\n': ('amr', 12),
+}
+# Signatures found away from the start of a file, which filetype checks before some of the formats above:
+# ISO base media (e.g. M4A) files, DICOM images and tar archives.
+_FILETYPE_MARKERS = (
+    (4, b'ftyp'),
+    (128, b'DICM'),
+    (257, b'ustar'),
+)
+_MAGIC_NUMBER_LENGTHS = sorted({len(magic_number) for magic_number in _MAGIC_NUMBERS}, reverse=True)
+_MAGIC_NUMBER_MIME_TYPES = {
+    magic_number: (matcher.mime, min_length)
+    for magic_number, (extension, min_length) in _MAGIC_NUMBERS.items()
+    for matcher in filetype_types
+    if matcher.extension == extension
+}
+
+# Flags for reading file headers straight from the host filesystem. O_NOATIME is only permitted for files we own,
+# so _read_file_header() retries without it.
+_HEADER_OPEN_FLAGS = os.O_RDONLY | getattr(os, 'O_BINARY', 0)
+_HEADER_OPEN_FLAGS_NOATIME = _HEADER_OPEN_FLAGS | getattr(os, 'O_NOATIME', 0)
+
+# File type bits of st_mode, compared directly rather than through stat.S_ISDIR() etc. on the traversal hot path.
+_S_IFMT = stat.S_IFMT(0o177777)
+_S_IFDIR = stat.S_IFDIR
+_S_IFREG = stat.S_IFREG
+
+
+def _split_extension(path):
+    """
+    Return the extension of 'path' without its dot, or None if it has none.
+    """
+    stem, dot, extension = path.rpartition('/')[2].rpartition('.')
+    return extension if stem and dot else None
+
+
+def _mime_type_from_extension(path):
+    """
+    Return the MIME type for 'path' if it has a trusted extension, otherwise None.
+    """
+    extension = _split_extension(path)
+    if extension is None:
+        return None
+
+    return _TRUSTED_EXTENSION_MIME_TYPES.get(extension.lower())
+
+
+def _sniff_mime_type(fs, path, size):
+    """
+    Determine the MIME type of 'path' (of 'size' bytes) from its contents, falling back to its name.
+    """
+    first_bytes = _read_file_header(fs, path, min(size, FILE_HEADER_GUESS_LENGTH))
+
+    if not first_bytes:
+        return MIME_TYPE_CANNOT_DETERMINE
+
+    mime_type = _mime_type_from_magic_number(first_bytes)
+    if mime_type is not None:
+        return mime_type
+
+    filetype = filetype_guess(first_bytes)
+    if filetype is None:
+        extension = _split_extension(path)
+        if extension is None:
+            return MIME_TYPE_CANNOT_DETERMINE
+
+        mime_type = _MIMETYPES_BY_EXTENSION.get(extension.lower())
+        if mime_type is None:
+            mime_type = mimetypes.guess_type(path)[0]
+        return mime_type or MIME_TYPE_CANNOT_DETERMINE
+
+    return filetype.mime
+
+
+def _mime_type_from_magic_number(first_bytes):
+    """
+    Return the MIME type for a file starting with 'first_bytes' if it starts with a known magic number, otherwise None.
+    """
+    for offset, marker in _FILETYPE_MARKERS:
+        if first_bytes[offset:offset + len(marker)] == marker:
+            return None
+
+    for length in _MAGIC_NUMBER_LENGTHS:
+        mime_type_and_min_length = _MAGIC_NUMBER_MIME_TYPES.get(first_bytes[:length])
+        if mime_type_and_min_length is not None and len(first_bytes) >= mime_type_and_min_length[1]:
+            return mime_type_and_min_length[0]
+
+    return None
+
+
+def _mime_type_for_stat(fs, path, stat_val):
+    """
+    Determine the MIME type of 'path', which has the stat result 'stat_val'.
+    """
+    mode_type = stat_val.st_mode & _S_IFMT
+    if mode_type == _S_IFDIR:
+        return MIME_TYPE_DIRECTORY
+    elif mode_type == _S_IFREG:
+        if stat_val.st_size == 0:
+            # Nothing to sniff, so don't open the file.
+            return MIME_TYPE_CANNOT_DETERMINE
+
+        return _mime_type_from_extension(path) or _sniff_mime_type(fs, path, stat_val.st_size)
+
+    return MIME_TYPE_CANNOT_DETERMINE
+
+
+def _read_file_header(fs, path, length):
+    """
+    Return up to the first 'length' bytes of 'path'.
+
+    Files on the host filesystem are read with os.open()/os.read(), avoiding the file object layers.
+    """
+    syspath = fs.syspath(path)
+    if syspath is None:
+        with fs.open(path) as f:
+            return f.read(length)
+
+    try:
+        fd = os.open(syspath, _HEADER_OPEN_FLAGS_NOATIME)
+    except PermissionError:
+        fd = os.open(syspath, _HEADER_OPEN_FLAGS)
+
+    try:
+        return os.read(fd, length)
+    finally:
+        os.close(fd)
+
+
+@dataclass(eq=True, frozen=True, slots=True)
 class DirEntry:
     """
     Represents a file or directory on a device.
+
+    There is one of these per file in a walk, so it has no per-instance __dict__.
     """
     path: str  # Full path name
     stat_val: os.stat_result
     mime_type: str
 
+    def __hash__(self):
+        # Equal DirEntries have equal paths, and str caches its hash, so don't hash the stat result.
+        return hash(self.path)
+
     def is_dir(self):
-        return stat.S_ISDIR(self.stat_val.st_mode)
+        return (self.stat_val.st_mode & _S_IFMT) == _S_IFDIR
 
     def is_file(self):
-        return stat.S_ISREG(self.stat_val.st_mode)
+        return (self.stat_val.st_mode & _S_IFMT) == _S_IFREG
 
     def stat(self):
         return self.stat_val
 
     @classmethod
-    def from_path(cls, fs, path):
-        stat_val = fs.stat(path)
-
-        if stat.S_ISDIR(stat_val.st_mode):
-            mime_type = MIME_TYPE_DIRECTORY
-        elif stat.S_ISREG(stat_val.st_mode):
-            with fs.open(path) as f:
-                first_bytes = f.read(FILE_HEADER_GUESS_LENGTH)
-
-            if not first_bytes:
-                mime_type = MIME_TYPE_CANNOT_DETERMINE
-            else:
-                filetype = filetype_guess(first_bytes)
-                if filetype is None:
-                    mime_type = mimetypes.guess_type(path)[0] or MIME_TYPE_CANNOT_DETERMINE
-                else:
-                    mime_type = filetype.mime
-        else:
-            mime_type = MIME_TYPE_CANNOT_DETERMINE
+    def from_path(cls, fs, path, stat_val=None, mime_type=None):
+        """
+        Create a DirEntry for 'path' on 'fs'. Pass 'stat_val' if the caller has already stat()ed the path,
+        and 'mime_type' if the file's MIME type is already known.
+        """
+        if stat_val is None:
+            stat_val = fs.stat(path)
+
+        if mime_type is None:
+            mime_type = _mime_type_for_stat(fs, path, stat_val)
 
         return cls(path, stat_val, mime_type)
@@ -1,6 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import io
 import os
 import posixpath
+import stat
+import weakref
 
+import fs.osfs
+from fs.error_tools import convert_os_errors
+
+from .base import walk_depth_first, walk_batched_depth_first
 from .ensuredir import ensuredir
 from . import metadata
 from ..sql import sqlite3_connect_filename as sqlite3_connect_with_regex_support
@@ -8,51 +17,174 @@ from ..sql import sqlite3_connect_filename as sqlite3_connect_with_regex_support
 from logging import getLogger
 log = getLogger(__name__)
 
+# Directory listings read ahead by walk(), and how many subdirectories of each directory to read ahead.
+_PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix='rime-prefetch')
+_PREFETCH_DIRECTORIES = 4
+
+# Flags for the descriptor of an OSFS root, which is only used to resolve paths relative to it.
+_ROOT_OPEN_FLAGS = getattr(os, 'O_PATH', os.O_RDONLY) | getattr(os, 'O_DIRECTORY', 0)
+
 
 class FSLibFilesystem:
     def __init__(self, _fs, metadata_db_path):
         self._fs = _fs
+        self._is_osfs = isinstance(_fs, fs.osfs.OSFS)
+
+        # Translating a path is pure string manipulation, so cache it. Filesystems with no system paths (e.g. zip
+        # files) raise NoSysPath for every path; note that once rather than catching an exception per call.
+        self._has_syspath = _fs.hassyspath('/')
+        self._getsyspath = lru_cache(maxsize=4096)(_fs.getsyspath) if self._has_syspath else _fs.getsyspath
+
+        # Where supported, stat() host files relative to a descriptor for the root rather than walking the whole
+        # system path from / each time.
+        self._root_fd = None
+        if self._is_osfs and os.stat in os.supports_dir_fd:
+            self._root_fd = os.open(self._getsyspath('/'), _ROOT_OPEN_FLAGS)
+            weakref.finalize(self, os.close, self._root_fd)
+
         self.metadata = metadata.MetadataDb(metadata_db_path)
 
     def dirname(self, pathname):
-        if '/' not in pathname:
-            return '/'
-
-        return pathname[:pathname.rindex('/')]
+        head, sep, _ = pathname.rpartition('/')
+        return head if sep else '/'
 
     def basename(self, pathname):
-        if '/' not in pathname:
-            return pathname
+        return pathname.rpartition('/')[2]
 
-        return pathname[pathname.rindex('/') + 1:]
+    def _direct_syspath(self, path):
+        """
+        Return the system path of 'path' if it can be used directly, or None to go through the fs layer.
+
+        This skips OSFS's path validation, which costs more than the system call for small operations. Paths
+        with no '..' can't escape the root; any others go through OSFS so that it can reject them.
+        """
+        if self._is_osfs and '..' not in path:
+            return self._getsyspath(path)
+
+        return None
 
     def exists(self, path):
-        return self._fs.exists(path)
+        syspath = self._direct_syspath(path)
+        if syspath is None:
+            return self._fs.exists(path)
+
+        return os.path.exists(syspath)
 
     def getsize(self, path):
-        return self._fs.getsize(path)
+        syspath = self._direct_syspath(path)
+        if syspath is None:
+            return self._fs.getsize(path)
+
+        with convert_os_errors('getsize', path):
+            return os.stat(syspath).st_size
 
     def open(self, path):
-        return self._fs.open(path, 'rb')
+        syspath = self._direct_syspath(path)
+        if syspath is None:
+            return self._fs.open(path, 'rb')
+
+        with convert_os_errors('open', path):
+            return io.open(syspath, 'rb')
+
+    def syspath(self, path):
+        return self._getsyspath(path) if self._has_syspath else None
 
     def stat(self, pathname):
-        return os.stat(self._fs.getsyspath(pathname))
+        if not self._has_syspath:
+            # Not backed by the OS filesystem (e.g. a zip file), so synthesise what we can.
+            return self._stat_from_info(self._fs.getinfo(pathname, namespaces=['details']))
+
+        if self._root_fd is not None and '..' not in pathname:
+            return os.stat(pathname.lstrip('/') or '.', dir_fd=self._root_fd)
+
+        return os.stat(self._getsyspath(pathname))
+
+    @staticmethod
+    def _stat_from_info(info):
+        mode = (stat.S_IFDIR | 0o755) if info.is_dir else (stat.S_IFREG | 0o644)
+        size = info.get('details', 'size', 0)
+        mtime = info.get('details', 'modified') or 0
+
+        return os.stat_result((
+            mode,
+            0,  # st_ino
+            0,  # st_dev
+            1,  # st_nlink
+            0,  # st_uid
+            0,  # st_gid
+            size,
+            mtime,  # st_atime
+            mtime,  # st_mtime
+            mtime,  # st_ctime
+        ))
 
     def scandir(self, path):
-        pathnames = [posixpath.join(path, name) for name in self._fs.listdir(path)]
-
-        return metadata.get_dir_entries_and_update_db(self, self.metadata, pathnames)
+        if not self._has_syspath:
+            pathnames = [posixpath.join(path, name) for name in self._fs.listdir(path)]
+            return metadata.get_dir_entries_and_update_db(self, self.metadata, pathnames)
+
+        # On the host filesystem, use os.scandir() so that new entries can be stat()ed from the os.DirEntry
+        # rather than by translating each pathname again.
+        os_dir_entries = self._list_dir(path)
+        return metadata.get_dir_entries_and_update_db(self, self.metadata, list(os_dir_entries), os_dir_entries)
+
+    def _list_dir(self, path):
+        """
+        Return a map of pathname to os.DirEntry for the contents of 'path' on the host filesystem.
+        """
+        with convert_os_errors('scandir', path, directory=True):
+            with os.scandir(self._getsyspath(path)) as it:
+                return {posixpath.join(path, entry.name): entry for entry in it}
+
+    def walk(self, path):
+        """
+        As DeviceFilesystem.walk().
+        """
+        return walk_depth_first(self._walk_scandir(), path)
+
+    def walk_batched(self, path, batch_size=256):
+        """
+        As DeviceFilesystem.walk_batched().
+        """
+        return walk_batched_depth_first(self._walk_scandir(), path, batch_size)
+
+    def _walk_scandir(self):
+        """
+        Return a scandir() function for a single walk.
+
+        On the host filesystem, the listings of the first few subdirectories of each directory are read in the
+        background while the caller works through the directory. The metadata database is only used from this
+        thread.
+        """
+        if not self._has_syspath:
+            return self.scandir
+
+        prefetched = {}
+
+        def scandir(path):
+            future = prefetched.pop(path, None)
+            os_dir_entries = future.result() if future is not None else self._list_dir(path)
+            dir_entries = metadata.get_dir_entries_and_update_db(self, self.metadata, list(os_dir_entries),
+                                                                 os_dir_entries)
+
+            subdirs = [dir_entry.path for dir_entry in dir_entries if dir_entry.is_dir()]
+            for subdir in subdirs[:_PREFETCH_DIRECTORIES]:
+                prefetched[subdir] = _PREFETCH_EXECUTOR.submit(self._list_dir, subdir)
+
+            return dir_entries
+
+        return scandir
 
     def create_file(self, path):
-        ensuredir(self._fs.getsyspath(path))
+        ensuredir(self._getsyspath(path))
 
         return self._fs.open(path, 'wb')
 
     def sqlite3_connect(self, path, read_only=True):
-        return sqlite3_connect_with_regex_support(self._fs.getsyspath(path), read_only=read_only)
+        return sqlite3_connect_with_regex_support(self._getsyspath(path), read_only=read_only)
 
     def sqlite3_create(self, path):
-        syspath = self._fs.getsyspath(path)
+        syspath = self._getsyspath(path)
 
         ensuredir(syspath)
 
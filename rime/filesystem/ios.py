@@ -3,16 +3,15 @@
 # Copyright 2023 Telemarq Ltd
 from abc import ABC, abstractmethod
 import datetime
+from functools import lru_cache
 import os
 import plistlib
 import hashlib
 import logging
 import shutil
-import sqlite3
 import tempfile
 from typing import Optional
 import zipfile
-import posixpath
 
 from iphone_backup_decrypt import EncryptedBackup  # pyright: ignore[reportMissingImports]
 
@@ -22,16 +21,57 @@ from .exceptions import NoPassphraseError, NotDecryptedError, WrongPassphraseErr
 from .ensuredir import ensuredir
 from . import metadata
 from . import zipsupport
-from ..sql import Table, Query, get_field_indices, sqlite3_connect_filename as sqlite3_connect_with_regex_support
+from ..sql import Table, Query, sqlite3, sqlite3_connect_filename as sqlite3_connect_with_regex_support
 
-logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
+# Statements run against Manifest.db. They are fixed, so they are written out rather than built per call.
+_SQL_SELECT_FILE_IDS = "SELECT domain, relativePath, fileID FROM Files"
+_SQL_SELECT_FILE_BY_ID = "SELECT relativePath, domain FROM Files WHERE fileID=?"
+_SQL_INSERT_FILE = "INSERT INTO Files (fileID, domain, relativePath) VALUES (?, ?, ?)"
+_SQL_SELECT_RELATIVE_PATHS = "SELECT relativePath FROM Files WHERE relativePath=?"
+
+@lru_cache(maxsize=1024)
+def _ios_domain_hasher(domain):
+    """
+    Return a SHA-1 object which has already hashed the 'domain-' prefix of paths in 'domain'. Backups have a few
+    hundred domains at most, and each is shared by many files.
+    """
+    return hashlib.sha1(f"{domain}-".encode())
+
+
+def _blob_exists(syspath):
+    """
+    Return True if 'syspath' exists. Blobs are looked up by hashed name rather than listed, so this is one stat()
+    per call.
+    """
+    try:
+        os.stat(syspath)
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+
+    return True
+
+
 class _IosManifest:
     def __init__(self, manifest_conn):
         self.manifest_conn = manifest_conn
         self.file_table = Table('Files')
         self._scandir_cache = {}
+        self._hashed_pathname_cache: dict[str, str] = {}
+        self._file_ids: Optional[dict[tuple[str, str], str]] = None
+
+    def _get_file_ids(self):
+        """
+        Return a map of (domain, relativePath) to fileID for every file in the manifest, read on first use.
+        """
+        if self._file_ids is None:
+            try:
+                self._file_ids = {(row[0], row[1]): row[2] for row in self.manifest_conn.execute(_SQL_SELECT_FILE_IDS)}
+            except sqlite3.OperationalError:
+                self._file_ids = {}
+
+        return self._file_ids
 
     @staticmethod
     def _get_ios_hash(domain, relative_path):
@@ -39,9 +79,10 @@ class _IosManifest:
         # The string used for hashing is of the form domain-relativePath, i.e. the same as 'path' with the first
         # slash replaced with a hyphen. We don't use this form in the rest of RIME because domains can contain hyphens,
         # so we wouldn't know where to split.
-        hashable_path = f"{domain}-{relative_path}"
+        hasher = _ios_domain_hasher(domain).copy()
+        hasher.update(relative_path.encode())
 
-        return hashlib.sha1(hashable_path.encode()).hexdigest()
+        return hasher.hexdigest()
 
     def get_hashed_pathname(self, path):
         """
@@ -53,24 +94,21 @@ class _IosManifest:
         referenced by the path HomeDomain/Library/SMS/sms.db.
         """
         # TODO: some files are stored in blobs in the manifest. Need to deal with that.
+        # The mapping doesn't change for the life of a backup, so remember it.
+        hashed_pathname = self._hashed_pathname_cache.get(path)
+        if hashed_pathname is not None:
+            return hashed_pathname
+
         domain, relative_path = path.split('/', 1)
 
         # First, attempt to look up the file in the manifest.
-        query = Query.from_(self.file_table).select('fileID')\
-            .where(self.file_table.domain == domain)\
-            .where(self.file_table.relativePath == relative_path)
-
-        try:
-            result = self.manifest_conn.execute(str(query)).fetchone()
-        except sqlite3.OperationalError:
-            result = None
-
-        if result:
-            file_id = result[0]
-        else:
+        file_id = self._get_file_ids().get((domain, relative_path))
+        if file_id is None:
             file_id = self._get_ios_hash(domain, relative_path)
 
-        return posixpath.join(file_id[:2], file_id)
+        hashed_pathname = f'{file_id[:2]}/{file_id}'
+        self._hashed_pathname_cache[path] = hashed_pathname
+        return hashed_pathname
 
     def add_file(self, path):
         """
@@ -81,20 +119,16 @@ class _IosManifest:
         domain, relative_path = path.split('/', 1)
         ios_hash = self._get_ios_hash(domain, relative_path)
 
-        query = Query.from_(self.file_table).select(self.file_table.relativePath, self.file_table.domain)\
-            .where(self.file_table.fileID == ios_hash)
-
-        result = self.manifest_conn.execute(str(query)).fetchone()
+        result = self.manifest_conn.execute(_SQL_SELECT_FILE_BY_ID, (ios_hash,)).fetchone()
 
         if not result:
             # File not in database.
-            query = Query.into(self.file_table)\
-                .columns(self.file_table.fileID, self.file_table.domain, self.file_table.relativePath)\
-                .insert(ios_hash, domain, relative_path)
-
-            self.manifest_conn.execute(str(query))
+            self.manifest_conn.execute(_SQL_INSERT_FILE, (ios_hash, domain, relative_path))
 
             self.manifest_conn.commit()
+            self._hashed_pathname_cache.pop(path, None)
+            if self._file_ids is not None:
+                self._file_ids[(domain, relative_path)] = ios_hash
         elif not (result[0] == relative_path and result[1] == domain):
             # File hash in database, but for a different file.
             raise FileExistsError(path)
@@ -114,11 +148,14 @@ class _IosManifest:
 
         query = Query.from_(self.file_table).select('fileID', 'relativePath', 'file')
         query = query.where(self.file_table.domain == domain)
-        fields = get_field_indices(query)
+
+        # Only this query reads columns by name, so use named rows for its cursor rather than the whole connection.
+        cursor = self.manifest_conn.cursor()
+        cursor.row_factory = sqlite3.Row
 
         entries = []
-        for row in self.manifest_conn.execute(str(query)):
-            name = row[fields['relativePath']]
+        for row in cursor.execute(str(query)):
+            name = row['relativePath']
 
             if not name.startswith(relative_path):
                 # Ignore files in directories above this one.
@@ -128,7 +165,7 @@ class _IosManifest:
                 # Ignore files in directories below this one.
                 continue
 
-            blob = row[fields['file']]
+            blob = row['file']
             blob_plist = plistlib.loads(blob)
 
             file_metadata = blob_plist['$objects'][1]
@@ -181,15 +218,29 @@ class IosDeviceFilesystem(DeviceFilesystem, IosDeviceFilesystemBase):
     def __init__(self, id_: str, root: str, metadata_db_path: str, writeable_manifest: bool = False, device_settings=None):
         self.id_ = id_
         self.root = root
+        self._root_sep = os.fspath(root) + os.sep
+        # The manifest is tuned below, so it has a connection of its own rather than a shared read-only one.
         self.manifest = sqlite3_connect_with_regex_support(
             os.path.join(self.root, 'Manifest.db'),
-            read_only=not writeable_manifest
+            read_only=not writeable_manifest,
+            shared=False
         )
+        if writeable_manifest:
+            # Only newly-created subsets have a writeable manifest, and add_file() commits once per file. A subset
+            # which fails part way through is deleted, so don't sync each commit, and keep the rollback journal in
+            # memory so that nothing but Manifest.db is left for later read-only (immutable) opens.
+            self.manifest.execute('PRAGMA synchronous=OFF')
+            self.manifest.execute('PRAGMA journal_mode=MEMORY')
+        else:
+            # Read-only manifests are opened immutable, so SQLite can map the whole file rather than read() each
+            # page. Manifests can be larger than the mapping every connection gets.
+            self.manifest.execute('PRAGMA mmap_size=1073741824')
         self.file_table = Table('Files')
         self._settings = DeviceSettings(root) if device_settings is None else device_settings
         self._converter = _IosManifest(self.manifest)
         self._metadata = metadata.MetadataDb(metadata_db_path)
         self._device_info = None
+        self._syspaths: dict[str, str] = {}
 
     @classmethod
     def is_device_filesystem(cls, path):
@@ -249,7 +300,7 @@ class IosDeviceFilesystem(DeviceFilesystem, IosDeviceFilesystemBase):
         return self._settings.is_subset_fs()
 
     def sqlite3_connect(self, path, read_only=True):
-        db_filename = os.path.join(self.root, self._converter.get_hashed_pathname(path))
+        db_filename = self.syspath(path)
         log.debug(f"iOS connecting to {path}")
         return sqlite3_connect_with_regex_support(db_filename, read_only=read_only)
 
@@ -260,18 +311,26 @@ class IosDeviceFilesystem(DeviceFilesystem, IosDeviceFilesystemBase):
         raise NotImplementedError()
 
     def exists(self, path):
-        real_path = self._converter.get_hashed_pathname(path)
-        return os.path.exists(os.path.join(self.root, real_path))
+        return _blob_exists(self.syspath(path))
 
     def getsize(self, path):
-        return os.path.getsize(os.path.join(self.root, self._converter.get_hashed_pathname(path)))
+        return os.path.getsize(self.syspath(path))
 
     def ios_open_raw(self, path, mode):
         return open(os.path.join(self.root, path), mode)
 
     def open(self, path):
         # TODO: Should cope with blobs in the manifest too
-        return self.ios_open_raw(self._converter.get_hashed_pathname(path), 'rb')
+        return open(self.syspath(path), 'rb')
+
+    def syspath(self, path):
+        # Providers look up the same few databases and media files repeatedly, so remember where they are.
+        syspath = self._syspaths.get(path)
+        if syspath is None:
+            syspath = f'{self._root_sep}{self._converter.get_hashed_pathname(path)}'
+            self._syspaths[path] = syspath
+
+        return syspath
 
     def create_file(self, path):
         raise NotImplementedError
@@ -281,11 +340,11 @@ class IosDeviceFilesystem(DeviceFilesystem, IosDeviceFilesystemBase):
         Create a new sqlite3 database at the given path and fail if it already exists.
         """
         self._converter.add_file(path)
+        self._syspaths.pop(path, None)
 
-        real_path = self._converter.get_hashed_pathname(path)
-        syspath = os.path.join(self.root, real_path)
+        syspath = self.syspath(path)
 
-        if self.exists(syspath):
+        if _blob_exists(syspath):
             raise FileExistsError(path)
 
         ensuredir(syspath)
@@ -304,7 +363,18 @@ class IosDeviceFilesystem(DeviceFilesystem, IosDeviceFilesystemBase):
             try:
                 # Note the Info.plist filename is at the top level: not hashed
                 info_plist_file = os.path.join(self.root, 'Info.plist')
-                if os.path.exists( info_plist_file):
+                try:
+                    info_plist_stat = os.stat(info_plist_file)
+                except FileNotFoundError:
+                    info_plist_stat = None
+
+                if info_plist_stat is not None:
+                    # Parsing Info.plist is slow, so keep the result in the metadata DB until the file changes.
+                    cache_key = f'{info_plist_stat.st_mtime_ns}:{info_plist_stat.st_size}'
+                    self._device_info = self._metadata.get_cached_device_info(cache_key)
+                    if self._device_info is not None:
+                        return self._device_info
+
                     log.debug(f"Reading {info_plist_file}")
                     with open(info_plist_file, 'rb') as f:
                         info_plist = plistlib.load(f)
@@ -316,6 +386,12 @@ class IosDeviceFilesystem(DeviceFilesystem, IosDeviceFilesystemBase):
                                 'Target Identifier', 'Target Type', 'Unique Identifier'
                             ]
                         }
+
+                    try:
+                        self._metadata.set_cached_device_info(cache_key, self._device_info)
+                    except TypeError:
+                        # Not every plist value can be represented in JSON. Such devices just aren't cached.
+                        pass
             except plistlib.InvalidFileException:
                 log.warning(f"Failed to read {info_plist_file}")
                 self._device_info = {}
@@ -342,18 +418,24 @@ class IosZippedDeviceFilesystem(DeviceFilesystem, IosDeviceFilesystemBase):
         # store the path of the root for other functions
         # to be able to open the zipfile
         self.root = root
-        self.zipped_filesystem = zipsupport.ZippedFilesystem(root)
+        # Unzip the files at the top of the backup, such as Manifest.db and Info.plist, straight away. The hashed
+        # blobs in subdirectories below them are unzipped when they are first needed on disk.
+        self.zipped_filesystem = zipsupport.ZippedFilesystem(
+            root, unzip_now=lambda name: name.rstrip('/').count('/') <= 1)
 
         # Find the unzipped root, which is the single directory below 'zipped_filesystem'
-        for elem in os.listdir(self.zipped_filesystem.unzipped_dirname):
-            if os.path.isdir(os.path.join(self.zipped_filesystem.unzipped_dirname, elem)):
-                self.unzipped_root = os.path.join(self.zipped_filesystem.unzipped_dirname, elem)
+        unzipped_dirname = self.zipped_filesystem.unzipped_dirname
+        for elem in os.listdir(unzipped_dirname):
+            elem_path = os.path.join(unzipped_dirname, elem)
+            if os.path.isdir(elem_path):
+                self.unzipped_root = elem_path
                 break
         else:
             raise ValueError("The zipfile does not contain a single directory.")
 
         self._settings = DeviceSettings(self.unzipped_root)
         self._real = IosDeviceFilesystem(id_, self.unzipped_root, metadata_db_path, device_settings=self._settings)
+        self._member_prefix = os.path.basename(self.unzipped_root) + '/'
 
     @classmethod
     def is_device_filesystem(cls, path) -> bool:
@@ -379,22 +461,53 @@ class IosZippedDeviceFilesystem(DeviceFilesystem, IosDeviceFilesystemBase):
     def get_dir_entry(self, path):
         return self._real.get_dir_entry(path)
 
+    def _member_name(self, path):
+        """
+        Return the name in the .zip file of the blob for 'path'.
+        """
+        return self._member_prefix + self._real._converter.get_hashed_pathname(path)
+
     def exists(self, path) -> bool:
-        return self._real.exists(path)
+        return self.zipped_filesystem.has_member(self._member_name(path))
 
     def getsize(self, path) -> int:
-        return self._real.getsize(path)
+        try:
+            return self.zipped_filesystem.getsize(self._member_name(path))
+        except KeyError:
+            raise FileNotFoundError(path)
 
     def ios_open_raw(self, path, mode):
         return self._real.ios_open_raw(path, mode)
 
     def open(self, path):
-        return self._real.open(path)
+        try:
+            return self.zipped_filesystem.open(self._member_name(path))
+        except KeyError:
+            raise FileNotFoundError(path)
+
+    def syspath(self, path):
+        """
+        Return the pathname of 'path' if it has been unzipped, otherwise None; see ensure_extracted().
+        """
+        syspath = self._real.syspath(path)
+        return syspath if os.path.exists(syspath) else None
+
+    def ensure_extracted(self, path):
+        """
+        Unzip the blob for 'path', if it hasn't been already, and return its pathname.
+        """
+        member_name = self._member_name(path)
+        if self.zipped_filesystem.has_member(member_name):
+            self.zipped_filesystem.extract(member_name)
+
+        return self._real.syspath(path)
 
     def create_file(self, path):
         return self._real.create_file(path)
 
     def sqlite3_connect(self, path, read_only=True):
+        # SQLite needs the database on disk.
+        self.ensure_extracted(path)
         return self._real.sqlite3_connect(path, read_only=read_only)
 
     def sqlite3_create(self, path):
@@ -423,6 +536,7 @@ class IosEncryptedDeviceFilesystem(DeviceFilesystem):
     def __init__(self, id_: str, root: str, metadata_db_path: str):
         self.id_ = id_
         self.root = root
+        self._root_sep = os.fspath(root) + os.sep
         self.file_table = Table('Files')
         self._settings = DeviceSettings(root)
 
@@ -445,6 +559,9 @@ class IosEncryptedDeviceFilesystem(DeviceFilesystem):
         self._backup = None
         self._metadata = metadata.MetadataDb(metadata_db_path)
 
+        # Paths of files known to have been decrypted alongside their encrypted blobs.
+        self._decrypted_files: set[str] = set()
+
     @classmethod
     def is_device_filesystem(cls, path):
         return (
@@ -470,17 +587,14 @@ class IosEncryptedDeviceFilesystem(DeviceFilesystem):
         if self.manifest is None:
             raise NotDecryptedError()
 
-        query = Query.from_(self.file_table).select('fileID', 'relativePath')
-        query = query.where(self.file_table.relativePath == os.path.join(self.root, path))
-        fields = get_field_indices(query)
-        return [row[fields['relativePath']] for row in self.manifest.execute(str(query))]
+        return [row[0] for row in self.manifest.execute(_SQL_SELECT_RELATIVE_PATHS, (os.path.join(self.root, path),))]
 
     def exists(self, path) -> bool:
         # If there is no _converter then there is no "Manifest-decrypted.db"
         # so return False to avoid crashing RIME.
         if self._converter:
             real_path = self._converter.get_hashed_pathname(path)
-            return os.path.exists(os.path.join(self.root, real_path))
+            return _blob_exists(f'{self._root_sep}{real_path}')
         else:
             return False
 
@@ -488,14 +602,14 @@ class IosEncryptedDeviceFilesystem(DeviceFilesystem):
         if self._converter is None:
             raise NotDecryptedError()
 
-        return os.path.getsize(os.path.join(self.root, self._converter.get_hashed_pathname(path)))
+        return os.path.getsize(f'{self._root_sep}{self._converter.get_hashed_pathname(path)}')
 
     def open(self, path):
         # TODO: Should cope with blobs in the manifest too
         if self._converter is None:
             raise NotDecryptedError()
 
-        return open(os.path.join(self.root, self._converter.get_hashed_pathname(path), 'rb'))
+        return open(f'{self._root_sep}{self._converter.get_hashed_pathname(path)}', 'rb')
 
     def create_file(self, path):
         raise NotImplementedError
@@ -512,11 +626,14 @@ class IosEncryptedDeviceFilesystem(DeviceFilesystem):
 
         # Decrypt the file and store it with a new filename
         decrypted_hashed_pathname = self._converter.get_hashed_pathname(path) + '-decrypted'
-        decrypted_file_path = os.path.join(self.root, decrypted_hashed_pathname)
+        decrypted_file_path = f'{self._root_sep}{decrypted_hashed_pathname}'
 
         # Decrypt the file only if it's not already decrypted
-        if not os.path.exists(decrypted_file_path):
-            self.decrypt_file(path, decrypted_hashed_pathname)
+        if decrypted_file_path not in self._decrypted_files:
+            if not os.path.exists(decrypted_file_path):
+                self.decrypt_file(path, decrypted_hashed_pathname)
+
+            self._decrypted_files.add(decrypted_file_path)
 
         # Connect to the decrypted SQLite DB
         log.debug(f"iOS connecting to {path}")
@@ -528,10 +645,9 @@ class IosEncryptedDeviceFilesystem(DeviceFilesystem):
         """
         self._converter.add_file(path)
 
-        real_path = self._converter.get_hashed_pathname(path)
-        syspath = os.path.join(self.root, real_path)
+        syspath = f'{self._root_sep}{self._converter.get_hashed_pathname(path)}'
 
-        if self.exists(syspath):
+        if _blob_exists(syspath):
             raise FileExistsError(path)
 
         ensuredir(syspath)
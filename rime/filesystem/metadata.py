@@ -3,29 +3,79 @@ Maintain a per-filesystem metadata cache.
 
 This is used internally by filesystems and exposed through filesystem datastructures such as DirEntry.
 """
+from concurrent.futures import ThreadPoolExecutor
+import json
+import math
 import os
-import pickle
+import stat
+import struct
+import threading
+from typing import Optional
 
 from ..sql import sqlite3_connect_filename, Table, Query, Parameter, Column
 from .direntry import DirEntry
 
+# Determining the MIME type of a new file is dominated by waiting on stat(), open() and read(), so new entries
+# are created in a thread pool when there are enough of them to be worth it. Threads are only started on first use.
+_DIR_ENTRY_EXECUTOR = ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4),
+                                         thread_name_prefix='rime-dir-entry')
+_DIR_ENTRY_EXECUTOR_THRESHOLD = 8
+
+# Version of the cache tables below, stored as the database's user_version. Tables from other versions are rebuilt.
+_SCHEMA_VERSION = 2
+_CACHE_TABLE_NAMES = ('mime_types', 'dir_entries', 'mime_cache')
+
+# Stat results are stored as mode, inode, device, link count, uid, gid and size followed by the access,
+# modification and change times as floats.
+_STAT_STRUCT = struct.Struct('<7Q3d')
+
+
+def _pack_stat(stat_val: os.stat_result) -> bytes:
+    return _STAT_STRUCT.pack(*stat_val[:7], stat_val.st_atime, stat_val.st_mtime, stat_val.st_ctime)
+
+
+def _unpack_stat(data: bytes) -> os.stat_result:
+    values = _STAT_STRUCT.unpack(data)
+    atime, mtime, ctime = values[7:]
+
+    return os.stat_result(
+        values[:7] + (math.floor(atime), math.floor(mtime), math.floor(ctime)),
+        {'st_atime': atime, 'st_mtime': mtime, 'st_ctime': ctime})
+
 
 class MetadataDb:
     def __init__(self, db_pathname):
-        self.settings_table = Table('settings')
         self.dir_entries_table = Table('dir_entries')
         self.mime_types_table = Table('mime_types')
+        self.mime_cache_table = Table('mime_cache')
 
         self.db = self._init_db(db_pathname)
         self._db_pathname = db_pathname
 
+        # The connection is shared by every thread using the filesystem (e.g. media requests run in a threadpool),
+        # so each method's use of it, and in particular each transaction, must not interleave with another's.
+        self._lock = threading.RLock()
+
     def _init_db(self, db_pathname):
         if not os.path.exists(os.path.dirname(db_pathname)):
             os.makedirs(os.path.dirname(db_pathname))
 
         conn = sqlite3_connect_filename(db_pathname, read_only=False)
 
+        # The metadata DB is a cache which can be rebuilt from the filesystem, so favour write speed over
+        # durability: a power cut may lose the last few transactions but won't corrupt the database.
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+
         with conn:
+            if conn.execute('PRAGMA user_version').fetchone()[0] != _SCHEMA_VERSION:
+                # Everything but the settings is a cache, so rather than migrating, start again.
+                for table_name in _CACHE_TABLE_NAMES:
+                    conn.execute(Query.drop_table(Table(table_name)).if_exists().get_sql())
+
+                conn.execute(f'PRAGMA user_version={_SCHEMA_VERSION}')
+
             query = Query.create_table(Table('settings')).if_not_exists().columns(
                 Column('key', 'TEXT'),
                 Column('value', 'TEXT'))\
@@ -33,19 +83,32 @@ class MetadataDb:
             conn.execute(query.get_sql())
 
             query = Query.create_table(Table('mime_types')).if_not_exists().columns(
-                Column('id', 'INT'),
+                Column('id', 'INTEGER'),
                 Column('mime_type', 'TEXT'))\
-                .primary_key('id')
+                .primary_key('id')\
+                .unique('mime_type')
             conn.execute(query.get_sql())
 
             query = Query.create_table(Table('dir_entries')).if_not_exists().columns(
-                Column('id', 'INT'),
+                Column('id', 'INTEGER'),
                 Column('path', 'TEXT'),
                 Column('mime_type_id', 'INT'),
-                Column('stat_val', 'TEXT'))\
+                Column('stat_val', 'BLOB'))\
                 .primary_key('id')
             conn.execute(query.get_sql())
 
+            # Entries are always looked up by path. (pypika has no CREATE INDEX.)
+            conn.execute('CREATE INDEX IF NOT EXISTS dir_entries_path ON dir_entries (path)')
+
+            query = Query.create_table(Table('mime_cache')).if_not_exists().columns(
+                Column('dev', 'INTEGER'),
+                Column('ino', 'INTEGER'),
+                Column('mtime', 'REAL'),
+                Column('size', 'INTEGER'),
+                Column('mime', 'TEXT'))\
+                .primary_key('dev', 'ino')
+            conn.execute(query.get_sql())
+
         return conn
 
     @classmethod
@@ -56,18 +119,18 @@ class MetadataDb:
 
     # Methods to use the settings table.
     def _get_setting(self, key):
-        query = Query.select(self.settings_table).where(self.settings_table.key == key)
-        result = self.db.execute(query).fetchone()
+        with self._lock:
+            result = self.db.execute("SELECT value FROM settings WHERE key=?", (key,)).fetchone()
 
         if result is None:
             return None
 
-        return result['value']
+        return result[0]
 
     def _set_setting(self, key, value):
-        query = Query.into(self.settings_table).insert(key=key, value=value).on_duplicate_key_update(value=value)
-        with self.db:
-            self.db.execute(str(query))
+        with self._lock, self.db:
+            self.db.execute("INSERT INTO settings (key, value) VALUES (?, ?)"
+                            " ON CONFLICT (key) DO UPDATE SET value=excluded.value", (key, value))
 
     def is_subset_fs(self):
         return self._get_setting('subset_fs') == '1'
@@ -87,6 +150,21 @@ class MetadataDb:
     def set_encrypted(self, is_encrypted):
         self._set_setting('encrypted', '1' if is_encrypted else '0')
 
+    def get_cached_device_info(self, key) -> Optional[dict]:
+        """
+        Return the device info stored by set_cached_device_info(), or None if there is none or it was stored
+        with a different 'key'.
+        """
+        value = self._get_setting('device_info')
+        if value is None:
+            return None
+
+        cached = json.loads(value)
+        return cached['info'] if cached['key'] == key else None
+
+    def set_cached_device_info(self, key, device_info: dict):
+        self._set_setting('device_info', json.dumps({'key': key, 'info': device_info}))
+
     # Methods to use the dir_entries table.
     def get_dir_entries_for_pathnames(self, pathnames: list[str]) -> list[DirEntry]:
         """
@@ -95,51 +173,46 @@ class MetadataDb:
         One or more pathnames may be missing in which case they will just not be returned. Filesystems
         are expected to call add_dir_entries_for_pathnames() to add the entries.
         """
-        query = Query \
-            .from_(self.dir_entries_table) \
-            .join(self.mime_types_table).on(self.dir_entries_table.mime_type_id == self.mime_types_table.id) \
-            .select(self.dir_entries_table.id, self.dir_entries_table.path,
-                    self.mime_types_table.mime_type, self.dir_entries_table.stat_val) \
-            .where(self.dir_entries_table.path.isin(pathnames))
-        results = self.db.execute(str(query)).fetchall()
-
-        return [DirEntry(path=result[1], stat_val=pickle.loads(result[3]),
-                         mime_type=result[2]) for result in results]
-
-    def add_dir_entries_for_pathnames(self, dir_entries: list[DirEntry]):
+        # Pass the pathnames as a single JSON array rather than writing each into the query, so the statement is
+        # the same whatever the number of pathnames.
+        with self._lock:
+            results = self.db.execute(
+                "SELECT dir_entries.path, mime_types.mime_type, dir_entries.stat_val FROM dir_entries"
+                " JOIN mime_types ON dir_entries.mime_type_id = mime_types.id"
+                " WHERE dir_entries.path IN (SELECT value FROM json_each(?))",
+                (json.dumps(pathnames),)).fetchall()
+
+        return [DirEntry(path=result[0], stat_val=_unpack_stat(result[2]),
+                         mime_type=result[1]) for result in results]
+
+    def add_dir_entries_for_pathnames(self, dir_entries: list[DirEntry],
+                                      mime_cache_entries: Optional[list[DirEntry]] = None):
         """
         Add DirEntries for the given pathnames.
 
-        The pathnames must not already exist in the database.
+        Pathnames already in the database, e.g. because another thread added them after this one looked, are
+        skipped. The MIME types of mime_cache_entries, if given, are added to the MIME cache in the same transaction.
         """
-        with self.db:
-            # Create or update mime type IDs from mime types.
+        with self._lock, self.db:
+            existing_pathnames = {row[0] for row in self.db.execute(
+                "SELECT path FROM dir_entries WHERE path IN (SELECT value FROM json_each(?))",
+                (json.dumps([dir_entry.path for dir_entry in dir_entries]),))}
+            if existing_pathnames:
+                dir_entries = [dir_entry for dir_entry in dir_entries if dir_entry.path not in existing_pathnames]
+
+            mime_types = list({dir_entry.mime_type for dir_entry in dir_entries})
+
+            # Add any new mime types, then map all of them to their IDs.
+            self.db.executemany("INSERT OR IGNORE INTO mime_types (mime_type) VALUES (?)",
+                                [(mime_type,) for mime_type in mime_types])
+
             query = Query \
                 .from_(self.mime_types_table) \
                 .select(self.mime_types_table.id, self.mime_types_table.mime_type) \
-                .where(self.mime_types_table.mime_type.isin([dir_entry.mime_type for dir_entry in dir_entries]))
+                .where(self.mime_types_table.mime_type.isin(mime_types))
             results = self.db.execute(str(query)).fetchall()
 
             mime_type_ids = {result[1]: result[0] for result in results}  # map mime type to ID
-            mime_types_to_add = [
-                dir_entry.mime_type
-                for dir_entry in dir_entries
-                if dir_entry.mime_type not in mime_type_ids]
-
-            if mime_types_to_add:
-                query = Query\
-                    .into(self.mime_types_table)\
-                    .columns('mime_type')\
-                    .insert(Parameter('?'))
-                self.db.executemany(str(query), [(typ,) for typ in mime_types_to_add])
-
-                query = Query\
-                    .from_(self.mime_types_table)\
-                    .select(self.mime_types_table.id, self.mime_types_table.mime_type)\
-                    .where(self.mime_types_table.mime_type.isin(mime_types_to_add))
-                results = self.db.execute(str(query)).fetchall()
-
-                mime_type_ids.update({result[1]: result[0] for result in results})  # map mime type to ID
 
             # Add the dir entries.
             query = Query\
@@ -148,18 +221,85 @@ class MetadataDb:
                 .insert(Parameter('?'), Parameter('?'), Parameter('?'))
 
             parameters = [
-                (dir_entry.path, mime_type_ids[dir_entry.mime_type], pickle.dumps(dir_entry.stat_val))
+                (dir_entry.path, mime_type_ids[dir_entry.mime_type], _pack_stat(dir_entry.stat_val))
                 for dir_entry in dir_entries
             ]
 
             self.db.executemany(str(query), parameters)
 
+            if mime_cache_entries:
+                self._set_cached_mime_types(mime_cache_entries)
+
+    # Methods to use the mime_cache table.
+    def get_cached_mime_types(self, stat_vals: list[os.stat_result]) -> dict[tuple[int, int], str]:
+        """
+        Return a map of (st_dev, st_ino) to MIME type for files whose MIME type was determined when they had
+        the same size and modification time as in 'stat_vals'.
+        """
+        if not stat_vals:
+            return {}
+
+        # As with the dir entry lookups, pass the keys as a single JSON array of [dev, ino] pairs so that the
+        # statement is the same whatever the number of files. Each pair is looked up through the primary key.
+        keys = [[stat_val.st_dev, stat_val.st_ino] for stat_val in stat_vals]
+        with self._lock:
+            results = {(result[0], result[1]): result[2:] for result in self.db.execute(
+                "SELECT mime_cache.dev, mime_cache.ino, mime_cache.mtime, mime_cache.size, mime_cache.mime"
+                " FROM json_each(?) AS keys CROSS JOIN mime_cache"
+                " ON mime_cache.dev = json_extract(keys.value, '$[0]')"
+                " AND mime_cache.ino = json_extract(keys.value, '$[1]')",
+                (json.dumps(keys),)).fetchall()}
+
+        mime_types = {}
+        for stat_val in stat_vals:
+            key = (stat_val.st_dev, stat_val.st_ino)
+            if key in results:
+                mtime, size, mime = results[key]
+                if mtime == stat_val.st_mtime and size == stat_val.st_size:
+                    mime_types[key] = mime
+
+        return mime_types
+
+    def _set_cached_mime_types(self, dir_entries: list[DirEntry]):
+        """
+        Remember the MIME types of 'dir_entries' against their device, inode, modification time and size.
+
+        Must be called inside a transaction, holding the lock.
+        """
+        query = Query\
+            .into(self.mime_cache_table)\
+            .columns('dev', 'ino', 'mtime', 'size', 'mime')\
+            .replace(Parameter('?'), Parameter('?'), Parameter('?'), Parameter('?'), Parameter('?'))
+
+        parameters = [
+            (dir_entry.stat_val.st_dev, dir_entry.stat_val.st_ino, dir_entry.stat_val.st_mtime,
+             dir_entry.stat_val.st_size, dir_entry.mime_type)
+            for dir_entry in dir_entries
+        ]
 
-def get_dir_entries_and_update_db(fs, metadata_db, pathnames: list[str]) -> list[DirEntry]:
+        self.db.executemany(str(query), parameters)
+
+
+def _has_mime_cache_key(stat_val: os.stat_result) -> bool:
+    """
+    Return True if 'stat_val' is a regular file with a real inode number. Files in zips have a synthesised
+    stat result with no inode, so they can't be told apart.
+    """
+    return stat.S_ISREG(stat_val.st_mode) and bool(stat_val.st_ino)
+
+
+def get_dir_entries_and_update_db(fs, metadata_db, pathnames: list[str],
+                                  os_dir_entries: Optional[dict[str, os.DirEntry]] = None) -> list[DirEntry]:
     """
     Get DirEntries for the given pathnames and return the results. If pathnames are
     missing, add them to the database.
 
+    os_dir_entries optionally maps pathnames to os.DirEntry objects from os.scandir(), which are used
+    to stat new entries.
+
+    The MIME types of new files are looked up by inode in the metadata database before the files are read,
+    so a file reached through another path (e.g. a symbolic link or hard link) is only sniffed once.
+
     Used internally by filesystem implementations.
     """
     dir_entries = metadata_db.get_dir_entries_for_pathnames(pathnames)
@@ -168,8 +308,26 @@ def get_dir_entries_and_update_db(fs, metadata_db, pathnames: list[str]) -> list
     pathnames_to_add = [pathname for pathname in pathnames if pathname not in found_pathnames]
 
     if pathnames_to_add:
-        dir_entries_to_add = [DirEntry.from_path(fs, pathname) for pathname in pathnames_to_add]
-        metadata_db.add_dir_entries_for_pathnames(dir_entries_to_add)
+        stat_vals = [
+            os_dir_entries[pathname].stat() if os_dir_entries else fs.stat(pathname)
+            for pathname in pathnames_to_add
+        ]
+        cached_mime_types = metadata_db.get_cached_mime_types(
+            [stat_val for stat_val in stat_vals if _has_mime_cache_key(stat_val)])
+
+        def _from_path(pathname, stat_val):
+            return DirEntry.from_path(fs, pathname, stat_val, cached_mime_types.get((stat_val.st_dev, stat_val.st_ino)))
+
+        if len(pathnames_to_add) > _DIR_ENTRY_EXECUTOR_THRESHOLD:
+            dir_entries_to_add = list(_DIR_ENTRY_EXECUTOR.map(_from_path, pathnames_to_add, stat_vals))
+        else:
+            dir_entries_to_add = list(map(_from_path, pathnames_to_add, stat_vals))
+
+        # Database updates stay on this thread, in a single transaction.
+        metadata_db.add_dir_entries_for_pathnames(dir_entries_to_add, [
+            dir_entry for dir_entry in dir_entries_to_add
+            if _has_mime_cache_key(dir_entry.stat_val)
+            and (dir_entry.stat_val.st_dev, dir_entry.stat_val.st_ino) not in cached_mime_types])
         dir_entries.extend(dir_entries_to_add)
 
     return dir_entries
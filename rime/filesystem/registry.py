@@ -3,6 +3,7 @@ import re
 from logging import getLogger
 import shutil
 
+from ..sql import sqlite3_close_pooled_connections
 from .base import DeviceFilesystem
 from .android import AndroidDeviceFilesystem, AndroidZippedDeviceFilesystem
 from .ios import IosDeviceFilesystem, IosZippedDeviceFilesystem, IosEncryptedDeviceFilesystem
@@ -37,12 +38,29 @@ class FilesystemRegistry:
             os.makedirs(self.metadata_path)
 
         self.filesystems = self._find_available_filesystems()  # maps key to FS object.
+        self.generations = self._find_generations()  # maps key to the identity of what's at its path.
 
     def __getitem__(self, key):
         return self.filesystems[key]
 
     def rescan(self):
         self.filesystems = self._find_available_filesystems()
+        self.generations = self._find_generations()
+
+    def _generation(self, key):
+        """
+        Identify what is at the path for 'key' now, so that a filesystem which has been deleted and recreated under
+        the same key, e.g. a subset being retried, can be told apart from the one it replaced.
+        """
+        try:
+            stat_val = os.stat(os.path.join(self.base_path, key))
+        except OSError:
+            return None
+
+        return (stat_val.st_dev, stat_val.st_ino, stat_val.st_ctime_ns)
+
+    def _find_generations(self):
+        return {key: self._generation(key) for key in self.filesystems}
 
     def _find_available_filesystems(self):
         """
@@ -87,6 +105,7 @@ class FilesystemRegistry:
         metadata_db_path = os.path.join(self.metadata_path, key + '.sqlite3')
         self.filesystems[key] = fs.__class__.create(key, path, metadata_db_path, template=fs)
         self.filesystems[key].lock(locked)
+        self.generations[key] = self._generation(key)
 
         return self[key]
 
@@ -97,5 +116,9 @@ class FilesystemRegistry:
         if key not in self.filesystems:
             raise FileNotFoundError(key)
 
-        shutil.rmtree(os.path.join(self.base_path, key))
+        device_path = os.path.join(self.base_path, key)
+        # Windows won't delete files which are open.
+        sqlite3_close_pooled_connections(device_path)
+        shutil.rmtree(device_path)
         del self.filesystems[key]
+        self.generations.pop(key, None)
@@ -1,10 +1,50 @@
-from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+import heapq
+import io
 import os
-import secrets
+import queue
 import shutil
-import tempfile
+import struct
+import threading
 import time
-from zipfile import ZipFile, Path, ZipInfo
+from typing import Callable, Optional
+from zipfile import BadZipFile, ZipFile, Path, ZipInfo, ZIP_DEFLATED
+import zlib
+
+try:
+    # libdeflate inflates about twice as fast as zlib. It's optional: without it, members are extracted by zipfile.
+    import deflate
+except ImportError:
+    deflate = None
+
+# Archives with fewer members than this are extracted on the calling thread.
+_PARALLEL_UNZIP_THRESHOLD = 64
+_UNZIP_WORKERS = min(os.cpu_count() or 1, 8)
+
+# Members up to this size are inflated in one go by libdeflate; larger ones are streamed by zipfile.
+_LIBDEFLATE_MAX_SIZE = 64 * 1024 * 1024
+
+# The fixed part of a zip local file header: signature, versions, flags, method, time, date, CRC, sizes, and the
+# lengths of the filename and extra field which follow it.
+_LOCAL_HEADER_STRUCT = struct.Struct('<4s5H3L2H')
+_LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+
+# Members read straight from the archive are buffered in larger chunks than ZipExtFile's own, so that each read
+# inflates more at once.
+_MEMBER_BUFFER_SIZE = 128 * 1024
+
+# Compressed members handed to libdeflate are read into buffers borrowed from this pool, rather than into a new bytes
+# object each. Buffers which have had to grow beyond _POOLED_BUFFER_MAX_SIZE are dropped when they're returned.
+_BUFFER_POOL = queue.SimpleQueue()
+_POOLED_BUFFER_SIZE = 64 * 1024
+_POOLED_BUFFER_MAX_SIZE = 4 * 1024 * 1024
+
+# Members unzipped by extract() are written to a '.partial' file at the top of the unzipped directory and then
+# renamed into place. Partial files which haven't been written to for this long were left by an extraction that
+# was interrupted, and are removed when the .zip file is next opened.
+_PARTIAL_SUFFIX = '.partial'
+_STALE_PARTIAL_AGE = 60 * 60
 
 def get_zipfile_main_dir(zf: ZipFile) -> Path:
     """
@@ -19,10 +59,12 @@ def get_zipfile_main_dir(zf: ZipFile) -> Path:
                 |- data
                     |- ...
     """
-    path = Path(zf)
-    for element in path.iterdir():
-        if element.is_dir():
-            return element
+    # Look at the names directly rather than through Path.iterdir(), which first works out every implied directory
+    # in the archive. The main directory is the first top-level name with something below it.
+    for name in zf.namelist():
+        main_dir_name, sep, _ = name.partition('/')
+        if sep:
+            return Path(zf, main_dir_name + '/')
 
     raise ValueError("The zipfile does not contain a single directory.")
 
@@ -32,76 +74,251 @@ def path_to_info(zf: ZipFile, path: Path) -> ZipInfo:
     """
     return zf.getinfo(str(path))
 
+def _partition_members(infos: list[ZipInfo], count: int) -> list[list[ZipInfo]]:
+    """
+    Split 'infos' into 'count' lists with roughly equal total compressed size, largest members first, so that
+    workers extracting one list each finish at about the same time.
+    """
+    bins = [(0, i, []) for i in range(count)]
+    for info in sorted(infos, key=lambda info: info.compress_size, reverse=True):
+        size, i, members = heapq.heappop(bins)
+        members.append(info)
+        heapq.heappush(bins, (size + info.compress_size, i, members))
+
+    return [members for _, _, members in bins if members]
+
+def _member_pathname(dest, info: ZipInfo):
+    """
+    Return where 'info' is extracted to beneath 'dest', or None if its name needs zipfile's sanitising.
+    """
+    parts = info.filename.rstrip('/').split('/')
+    if '\\' in info.filename or any(part in ('', '.', '..') or ':' in part for part in parts):
+        return None
+
+    return os.path.join(dest, *parts)
+
+@contextmanager
+def _borrowed_buffer(size):
+    """
+    Lend a writable memoryview of 'size' bytes backed by a pooled buffer.
+    """
+    try:
+        buf = _BUFFER_POOL.get_nowait()
+    except queue.Empty:
+        buf = bytearray(_POOLED_BUFFER_SIZE)
+
+    if len(buf) < size:
+        # Grow geometrically so that a run of slightly larger members doesn't reallocate each time.
+        buf = bytearray(max(size, 2 * len(buf)))
+
+    try:
+        yield memoryview(buf)[:size]
+    finally:
+        if len(buf) <= _POOLED_BUFFER_MAX_SIZE:
+            _BUFFER_POOL.put(buf)
+
+def _extract_member_libdeflate(fp, info: ZipInfo, pathname):
+    """
+    Inflate 'info' from the zip file open as 'fp' straight into 'pathname' using libdeflate.
+    """
+    fp.seek(info.header_offset)
+    header = _LOCAL_HEADER_STRUCT.unpack(fp.read(_LOCAL_HEADER_STRUCT.size))
+    if header[0] != _LOCAL_HEADER_SIGNATURE:
+        raise BadZipFile(f'Bad local file header for {info.filename}')
+
+    fp.seek(header[-2] + header[-1], os.SEEK_CUR)  # filename and extra field
+    with _borrowed_buffer(info.compress_size) as compressed:
+        if fp.readinto(compressed) != info.compress_size:
+            raise BadZipFile(f'Truncated data for {info.filename}')
+        data = deflate.deflate_decompress(compressed, info.file_size)
+    if zlib.crc32(data) != info.CRC:
+        raise BadZipFile(f'Bad CRC-32 for file {info.filename}')
+
+    with open(pathname, 'wb') as f:
+        f.write(data)
+
+def _can_use_libdeflate(info: ZipInfo):
+    return (deflate is not None and info.compress_type == ZIP_DEFLATED and not info.flag_bits & 0x1
+            and info.file_size <= _LIBDEFLATE_MAX_SIZE)
+
+def _extract_members(zipped_pathname, infos: list[ZipInfo], dest):
+    # Reads through one ZipFile are serialised, so each worker opens its own.
+    with ZipFile(zipped_pathname) as zf, open(zipped_pathname, 'rb') as fp:
+        for info in infos:
+            pathname = _member_pathname(dest, info)
+            if pathname is not None and _can_use_libdeflate(info):
+                _extract_member_libdeflate(fp, info, pathname)
+            else:
+                zf.extract(info, dest)
+
 class ZippedFilesystem:
-    def __init__(self, zipped_pathname):
+    """
+    A .zip file unzipped alongside itself.
+
+    If 'unzip_now' is given, only members for which it returns True are unzipped straight away. The rest are
+    unzipped by extract() when a caller needs them on disk, or read directly from the archive by open(). Opening
+    the same .zip file again without 'unzip_now' unzips whatever was left in the archive.
+    """
+    def __init__(self, zipped_pathname, unzip_now: Optional[Callable[[str], bool]] = None):
         self.zipped_pathname = zipped_pathname
         self.unzipped_dirname = self.zipped_pathname_to_unzipped_dirname(zipped_pathname)
 
-        if os.path.exists(self.unzipped_dirname):
-            if not self._is_unzipped():
-                shutil.rmtree(self.unzipped_dirname)
+        self._zf = ZipFile(zipped_pathname)
+        self._infos = {info.filename: info for info in self._zf.infolist()}
+        self._unzip_now = unzip_now
+        self._extract_lock = threading.Lock()
 
-        if not self._is_unzipped():
-            self._unzip()
+        marker = self._read_marker()
+        if marker == self._marker(lazy=False) or (unzip_now is not None and marker == self._marker(lazy=True)):
+            self._remove_stale_partial_files()
+            return
 
-    def _is_unzipped(self):
-        return os.path.exists(os.path.join(self.unzipped_dirname, 'complete'))
+        if marker == self._marker(lazy=True):
+            # Unzipped lazily from the current .zip file, and everything already on disk is complete, so only the
+            # members which were left in the archive need unzipping now.
+            self._remove_stale_partial_files()
+            self._unzip(missing_only=True)
+            return
 
-    def _unzip(self):
-        os.makedirs(self.unzipped_dirname, exist_ok=True)
+        if os.path.exists(self.unzipped_dirname):
+            shutil.rmtree(self.unzipped_dirname)
 
-        with ZipFile(self.zipped_pathname) as zf:
-            zf.extractall(self.unzipped_dirname)
+        self._unzip()
 
-        with open(os.path.join(self.unzipped_dirname, 'complete'), 'w') as f:
-            f.write(str(time.time()))
+    def has_member(self, name) -> bool:
+        return name in self._infos
 
-    @classmethod
-    def zipped_pathname_to_unzipped_dirname(cls, zipped_pathname):
+    def getsize(self, name) -> int:
+        return self._infos[name].file_size
+
+    def open(self, name):
         """
-        Convert a zipped pathname to an unzipped directory name.
+        Open member 'name' for reading without unzipping it to disk.
         """
-        dirname = os.path.dirname(zipped_pathname)
-        filename = os.path.splitext(os.path.basename(zipped_pathname))[0]
-
-        return os.path.join(dirname, f'_unzipped_{filename}')
+        return io.BufferedReader(self._zf.open(self._infos[name]), buffer_size=_MEMBER_BUFFER_SIZE)
 
-def temp_file_name() -> str:
-    """
-    Return a temporary file name. This is subject to race conditions but is the best we can do for Windows.
-    """
-    pathname = None
+    def extract(self, name) -> str:
+        """
+        Make sure member 'name' is unzipped and return its pathname.
+        """
+        info = self._infos[name]
+        pathname = _member_pathname(self.unzipped_dirname, info)
+        if pathname is None:
+            # Unusually-named members are always unzipped by _unzip(), so let zipfile say where it put it.
+            return self._zf.extract(info, self.unzipped_dirname)
 
-    for _ in range(10):
-        pathname = os.path.join(tempfile.gettempdir(), 'tmp' + secrets.token_hex(8))
         if not os.path.exists(pathname):
-            break
-    else:
-        pathname = None
+            with self._extract_lock:
+                if not os.path.exists(pathname):
+                    # Unzip to a temporary name first so that an interrupted extraction isn't mistaken for a
+                    # complete one later. Other processes may be unzipping the same member, so the name is ours.
+                    partial_pathname = os.path.join(
+                        self.unzipped_dirname, f'{os.getpid()}-{threading.get_ident()}{_PARTIAL_SUFFIX}')
+                    try:
+                        if _can_use_libdeflate(info):
+                            with open(self.zipped_pathname, 'rb') as fp:
+                                _extract_member_libdeflate(fp, info, partial_pathname)
+                        else:
+                            with self._zf.open(info) as src, open(partial_pathname, 'wb') as dst:
+                                shutil.copyfileobj(src, dst, _MEMBER_BUFFER_SIZE)
 
-    if not pathname:
-        raise FileExistsError("Could not create a temporary file.")
+                        os.replace(partial_pathname, pathname)
+                    except BaseException:
+                        with suppress(FileNotFoundError):
+                            os.unlink(partial_pathname)
+                        raise
 
-    return pathname
+        return pathname
 
-class TmpFile:
-    """
-    Produce a Windows-friendly temporary file which can be used as a context manager.
-    """
-    def __init__(self):
-        self.pathname = temp_file_name()
+    def _remove_stale_partial_files(self):
+        """
+        Remove partial files left at the top of the unzipped directory by interrupted calls to extract().
+        """
+        stale_before = time.time() - _STALE_PARTIAL_AGE
+        with os.scandir(self.unzipped_dirname) as it:
+            for entry in it:
+                if entry.name.endswith(_PARTIAL_SUFFIX) and entry.stat().st_mtime < stale_before:
+                    with suppress(FileNotFoundError):
+                        os.unlink(entry.path)
 
-    def __del__(self):
-        if os.path.exists(self.pathname):
-            os.unlink(self.pathname)
+    def _zipped_signature(self):
+        """
+        Identify the current contents of the .zip file by its modification time and size.
+        """
+        stat_val = os.stat(self.zipped_pathname)
+        return f'{stat_val.st_mtime_ns}:{stat_val.st_size}'
 
-    def open(self, mode='w+b'):
-        return open(self.pathname, mode)
+    def _marker(self, lazy):
+        """
+        Return what the 'complete' file holds once the current .zip file has been unzipped, either in full or only
+        in part because 'unzip_now' was given.
+        """
+        signature = self._zipped_signature()
+        return f'{signature}:lazy' if lazy else signature
 
-    @contextmanager
-    def context_manager(self, fn, *args, **kw):
+    def _read_marker(self):
+        """
+        Return the contents of the unzipped directory's 'complete' file, or None if it hasn't been written.
+        """
         try:
-            yield fn(*args, **kw)
-        finally:
-            if os.path.exists(self.pathname):
-                os.unlink(self.pathname)
+            with open(os.path.join(self.unzipped_dirname, 'complete')) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _unzip(self, missing_only=False):
+        """
+        Unzip the .zip file, or only those members which 'unzip_now' accepts if it was given. If 'missing_only',
+        members which are already on disk are left as they are.
+        """
+        os.makedirs(self.unzipped_dirname, exist_ok=True)
+
+        # Create every directory first so that members can be written without checking for their parents, and so
+        # that workers don't race to create the same parent. Members with unusual names are left to zipfile.
+        dirnames = set()
+        member_infos = []
+        for info in self._infos.values():
+            pathname = _member_pathname(self.unzipped_dirname, info)
+            if pathname is None:
+                member_infos.append(info)
+            elif info.is_dir():
+                dirnames.add(pathname)
+            else:
+                dirnames.add(os.path.dirname(pathname))
+                if missing_only and os.path.exists(pathname):
+                    continue
+                if self._unzip_now is None or self._unzip_now(info.filename):
+                    member_infos.append(info)
+
+        for dirname in sorted(dirnames):
+            os.makedirs(dirname, exist_ok=True)
+
+        if len(member_infos) < _PARALLEL_UNZIP_THRESHOLD or _UNZIP_WORKERS == 1:
+            _extract_members(self.zipped_pathname, member_infos, self.unzipped_dirname)
+        else:
+            self._unzip_parallel(member_infos)
+
+        with open(os.path.join(self.unzipped_dirname, 'complete'), 'w') as f:
+            f.write(self._marker(lazy=self._unzip_now is not None))
+
+    def _unzip_parallel(self, infos: list[ZipInfo]):
+        """
+        Extract 'infos' using several threads. Inflating releases the GIL, so this scales with the number of cores.
+        """
+        with ThreadPoolExecutor(max_workers=_UNZIP_WORKERS, thread_name_prefix='rime-unzip') as executor:
+            futures = [
+                executor.submit(_extract_members, self.zipped_pathname, members, self.unzipped_dirname)
+                for members in _partition_members(infos, _UNZIP_WORKERS)
+            ]
+            for future in futures:
+                future.result()
+
+    @classmethod
+    def zipped_pathname_to_unzipped_dirname(cls, zipped_pathname):
+        """
+        Convert a zipped pathname to an unzipped directory name.
+        """
+        dirname = os.path.dirname(zipped_pathname)
+        filename = os.path.splitext(os.path.basename(zipped_pathname))[0]
+
+        return os.path.join(dirname, f'_unzipped_{filename}')
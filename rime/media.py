@@ -8,3 +8,5 @@ class MediaData:
     # file-like object representing the media
     handle: typing.BinaryIO
     length: int
+    # pathname of the media on the host filesystem, if it is stored there as a plain file
+    syspath: typing.Optional[str] = None
@@ -3,7 +3,12 @@ import importlib
 import os
 from typing import Callable
 
-from yaml import load as load_yaml, Loader
+from yaml import load as load_yaml
+try:
+    # Use libyaml's parser when PyYAML was built with it.
+    from yaml import CSafeLoader as Loader
+except ImportError:
+    from yaml import SafeLoader as Loader  # type: ignore[assignment]
 
 BASE_PATH = os.path.dirname(os.path.abspath(__file__))
 
@@ -7,6 +7,7 @@ A provider which finds any media on the device not already found by other provid
 """
 from datetime import datetime
 from dataclasses import dataclass
+import re
 
 from ..provider import Provider
 from ..event import MediaEvent, GenericEventInfo
@@ -29,13 +30,17 @@ _DIRENTRY_TO_PROVIDER_PREFIXES = {
     '/sdcard/com.whatsapp/files/': DirentryProviderInfo(providernames.ANDROID_WHATSAPP, False),
 }
 
+# Matches whichever of the prefixes above a path starts with, longest first, in a single call.
+_DIRENTRY_PROVIDER_PREFIX_RE = re.compile('|'.join(
+    re.escape(prefix) for prefix in sorted(_DIRENTRY_TO_PROVIDER_PREFIXES, key=len, reverse=True)))
 
-def _guess_provider_for_entity(category) -> DirentryProviderInfo | None:
-    for prefix, info in _DIRENTRY_TO_PROVIDER_PREFIXES.items():
-        if category.startswith(prefix):
-            return info
 
-    return None
+def _guess_provider_for_entity(path) -> DirentryProviderInfo | None:
+    match = _DIRENTRY_PROVIDER_PREFIX_RE.match(path)
+    if match is None:
+        return None
+
+    return _DIRENTRY_TO_PROVIDER_PREFIXES[match.group()]
 
 
 class AndroidGenericMedia(Provider):
@@ -65,38 +70,49 @@ class AndroidGenericMedia(Provider):
         """
         Search for events matching ``filter_``, which is an EventFilter.
         """
-        for direntry in self.fs.walk('/sdcard'):
-            if not direntry.mime_type:
-                continue
-
-            if direntry.mime_type.startswith('image/') or direntry.mime_type.startswith('video/'):
-                category = self.fs.dirname(direntry.path)
-
-                # Attempt to label the provider. We either label it as definitively coming from a
-                # specific provider, or, if it's user or unknown content, we default to the
-                # unknown contact.
-                direntry_provider_info = _guess_provider_for_entity(category)
-                if direntry_provider_info and not direntry_provider_info.is_user_content:
-                    sender = device.provider_contact(direntry_provider_info.provider_name)
-                    is_user_generated = False
-                else:
-                    sender = device.unknown_contact
-                    is_user_generated = True
-
-                generic_event_info = GenericEventInfo(
-                    category=category,
-                    is_user_generated=is_user_generated,
-                )
-
-                yield MediaEvent(
-                    mime_type=direntry.mime_type,
-                    local_id=direntry.path,
-                    id_=direntry.path,
-                    timestamp=datetime.fromtimestamp(direntry.stat().st_ctime),
-                    generic_event_info=generic_event_info,
-                    provider=self,
-                    sender=sender,
-                )
+        dirname = self.fs.dirname
+
+        # Media files are grouped in a few directories, so remember the sender for each one.
+        senders_by_category = {}
+
+        for batch in self.fs.walk_batched('/sdcard'):
+            for direntry in batch:
+                mime_type = direntry.mime_type
+                if mime_type and mime_type.startswith(('image/', 'video/')):
+                    category = dirname(direntry.path)
+
+                    if category in senders_by_category:
+                        sender, is_user_generated = senders_by_category[category]
+                    else:
+                        # Attempt to label the provider. We either label it as definitively coming from a
+                        # specific provider, or, if it's user or unknown content, we default to the
+                        # unknown contact. The prefixes end in '/', so match them against the whole path: the
+                        # category has no trailing '/' and would miss files directly inside a prefix directory.
+                        # Every file in the category gets the same answer, so it's still only worked out once.
+                        direntry_provider_info = _guess_provider_for_entity(direntry.path)
+                        if direntry_provider_info and not direntry_provider_info.is_user_content:
+                            sender = device.provider_contact(direntry_provider_info.provider_name)
+                            is_user_generated = False
+                        else:
+                            sender = device.unknown_contact
+                            is_user_generated = True
+
+                        senders_by_category[category] = (sender, is_user_generated)
+
+                    generic_event_info = GenericEventInfo(
+                        category=category,
+                        is_user_generated=is_user_generated,
+                    )
+
+                    yield MediaEvent(
+                        mime_type=mime_type,
+                        local_id=direntry.path,
+                        id_=direntry.path,
+                        timestamp=datetime.fromtimestamp(direntry.stat().st_ctime),
+                        generic_event_info=generic_event_info,
+                        provider=self,
+                        sender=sender,
+                    )
 
     def search_contacts(self, filter_):
         """
@@ -114,4 +130,5 @@ class AndroidGenericMedia(Provider):
             mime_type=direntry.mime_type,
             handle=self.fs.open(direntry.path),
             length=direntry.stat().st_size,
+            syspath=self.fs.syspath(direntry.path),
         )
@@ -234,6 +234,7 @@ class AndroidWhatsApp(Provider):
             mime_type=mime_type,
             handle=self.fs.open(media_path),
             length=self.fs.getsize(media_path),
+            syspath=self.fs.syspath(media_path),
         )
 
     def _get_group_contacts(self, group_jid):
@@ -9,10 +9,11 @@ import logging
 import os
 import threading
 
+from watchfiles import awatch
+
 from .filesystem.registry import FilesystemRegistry
 from .filesystem.exceptions import WrongPassphraseError
 from .session import Session
-from .graphql import query as _graphql_query, query_async as _graphql_query_async
 from .config import Config
 from .plugins import load_plugin
 from .device import Device
@@ -26,6 +27,24 @@ RIME = threading.local()
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
+# watchfiles logs every change it sees at INFO.
+logging.getLogger('watchfiles.main').setLevel(logging.WARNING)
+
+
+def _flatten(d: dict, prefix=()) -> dict:
+    """
+    Return {(key, subkey, ...): value} for every value in nested dict 'd', including the nested dicts themselves.
+    """
+    flat = {}
+    for key, val in d.items():
+        path = prefix + (key,)
+        flat[path] = val
+        if isinstance(val, dict):
+            flat.update(_flatten(val, path))
+
+    return flat
+
+
 @dataclass(frozen=True)
 class AsyncEventListener:
     loop: asyncio.AbstractEventLoop
@@ -40,13 +59,14 @@ class Rime:
     """
     def __init__(self, session: Session, config: Config, enqueue_bg_call, async_loop=None):
         self.devices = []
+        self._device_for_id = None
         self.session = session
         self.config = config
+        self._flat_config = _flatten(config.yaml or {})
         self._enqueue_bg_call = enqueue_bg_call
         media_prefix = config.get('media_url_prefix', '/media/')
         self._event_listeners_lock = threading.Lock()
         self._event_listeners = defaultdict(set[AsyncEventListener])  # event_name -> {listener, ...}
-        self._events_queue = asyncio.Queue()
 
         self.rescan_devices()
 
@@ -74,23 +94,39 @@ class Rime:
         registry.rescan()
 
         if not hasattr(DEVICE_CACHE, 'devices'):
-            DEVICE_CACHE.devices = []
-
-        new_devices = []
-        old_devices = {}
-        for device in DEVICE_CACHE.devices:
-            if device.id_ in registry.filesystems:
-                old_devices[device.id_] = device
-
-        for device_id, fs in registry.filesystems.items():
-            if device_id not in old_devices:
-                device = Device(device_id, fs, self.session)
-                new_devices.append(device)
-
-        DEVICE_CACHE.devices = new_devices + list(old_devices.values())
-
-        self.devices = DEVICE_CACHE.devices
-        self._device_for_id = {device.id_: device for device in self.devices}
+            DEVICE_CACHE.devices = {}  # device ID -> Device
+            DEVICE_CACHE.generations = {}  # device ID -> registry generation the Device was made from
+
+        removed_ids = DEVICE_CACHE.devices.keys() - registry.filesystems.keys()
+        added_ids = registry.filesystems.keys() - DEVICE_CACHE.devices.keys()
+        # Devices deleted and recreated under the same ID since we last looked are made again.
+        changed_ids = {
+            device_id
+            for device_id in DEVICE_CACHE.devices.keys() - removed_ids
+            if DEVICE_CACHE.generations.get(device_id) != registry.generations.get(device_id)
+        }
+
+        if removed_ids or added_ids or changed_ids:
+            # New devices go first, followed by the devices we already knew about.
+            new_devices = {
+                device_id: Device(device_id, fs, self.session)
+                for device_id, fs in registry.filesystems.items()
+                if device_id in added_ids
+            }
+            old_devices = {
+                device_id: Device(device_id, registry[device_id], self.session) if device_id in changed_ids else device
+                for device_id, device in DEVICE_CACHE.devices.items()
+                if device_id not in removed_ids
+            }
+            DEVICE_CACHE.devices = new_devices | old_devices
+            DEVICE_CACHE.generations = {device_id: registry.generations.get(device_id)
+                                        for device_id in DEVICE_CACHE.devices}
+        elif self._device_for_id is DEVICE_CACHE.devices:
+            # Nothing has changed since we last looked.
+            return
+
+        self._device_for_id = DEVICE_CACHE.devices
+        self.devices = list(DEVICE_CACHE.devices.values())
 
     # TODO: Need a synchronous version of this (or, better, a single version that can be used in both contexts)
     async def start_background_tasks_async(self):
@@ -98,17 +134,25 @@ class Rime:
 
         async def watch_files_async(base_path):
             old_files = set()
-            while not self._file_watcher_stop_event.is_set():
+
+            def rescan_if_changed():
+                nonlocal old_files
                 files = set(os.listdir(base_path))
                 if files != old_files:
                     old_files = files
                     self.rescan_devices()
 
-                await asyncio.sleep(0.5)
+            rescan_if_changed()
+
+            # Wait for the OS to report changes to the top level of the base path rather than polling it. In case a
+            # change is missed (e.g. on a network filesystem), look anyway once a minute.
+            async for _ in awatch(base_path, watch_filter=None, debounce=200, recursive=False,
+                                  stop_event=self._file_watcher_stop_event,
+                                  rust_timeout=60_000, yield_on_timeout=True):
+                rescan_if_changed()
 
         for async_task in (
                 watch_files_async(self.filesystem_registry.base_path),
-                self._event_handler(),
                 self._device_list_updated_watcher()):
             self._async_tasks.append(self.async_loop.create_task(async_task))
 
@@ -118,20 +162,23 @@ class Rime:
             task.cancel()
 
     def devices_for_ids(self, device_ids: list[str]) -> list[Device]:
-        return [device for device in self.devices if device.id_ in device_ids]
+        device_for_id = self._device_for_id
+        return [device_for_id[device_id] for device_id in dict.fromkeys(device_ids) if device_id in device_for_id]
 
     def device_for_id(self, device_id: str) -> Device:
         return self._device_for_id[device_id]
 
     def has_device(self, device_id: str) -> bool:
-        return any(device.id_ == device_id for device in self.devices)
+        return device_id in self._device_for_id
 
     def create_empty_subset_of(self, device, new_device_id, locked=True):
-        if any(new_device_id == device.id_ for device in self.devices):
+        if new_device_id in self._device_for_id:
             raise ValueError(f"Device ID {new_device_id} already exists")
 
         new_fs = self.filesystem_registry.create_empty_subset_of(device.fs, new_device_id, locked=locked)
         new_device = Device(new_device_id, new_fs, self.session)
+        self._device_for_id[new_device_id] = new_device
+        DEVICE_CACHE.generations[new_device_id] = self.filesystem_registry.generations.get(new_device_id)
         self.devices.append(new_device)
 
         return new_device
@@ -170,10 +217,13 @@ class Rime:
         except WrongPassphraseError:
             return False
 
+    # The GraphQL layer pulls in Ariadne and builds the schema, so import it only when a query is made.
     def query(self, query_json: dict):
+        from .graphql import query as _graphql_query
         return _graphql_query(self, query_json)
 
     async def query_async(self, query_json: dict):
+        from .graphql import query_async as _graphql_query_async
         return await _graphql_query_async(self, query_json)
 
     async def wait_for_events_async(self, event_name):
@@ -195,19 +245,14 @@ class Rime:
             with self._event_listeners_lock:
                 self._event_listeners[event_name].remove(listener)
 
-    async def _event_handler(self):
-        while True:
-            event_name, args = await self._events_queue.get()
-
-            for listener in self._event_listeners[event_name]:
+    def publish_event(self, event_name, *args):
+        with self._event_listeners_lock:
+            for listener in self._event_listeners.get(event_name, ()):
                 if isinstance(listener, AsyncEventListener):
                     listener.queue.put_nowait(args)
                 else:
                     raise ValueError(f"Unknown event listener type {type(listener)}")
 
-    def publish_event(self, event_name, *args):
-        self._events_queue.put_nowait((event_name, args))
-
     def get_media(self, media_path):
         """
         Return (handle, content-type)
@@ -225,13 +270,7 @@ class Rime:
         if not isinstance(path, list):
             raise ValueError("path must be a list")
 
-        val = self.config
-        for key in path[:-1]:
-            if key not in val:
-                return default
-            val = val[key]
-
-        return val.get(path[-1], default)
+        return self._flat_config.get(tuple(path), default)
 
     @property
     def filesystem_registry(self) -> FilesystemRegistry:
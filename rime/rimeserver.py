@@ -2,11 +2,16 @@
 Serve GraphQL on a socket with FastAPI.
 
 Designed to be run from a frontend such as Uvicorn; use create_app as a factory.
+
+FastAPI, Starlette, Ariadne and RIME's GraphQL layer are imported by create_app() rather than at module level:
+`import rime` imports this module, and background task workers and other users of RIME don't need a web server.
 """
 
 import asyncio
 import concurrent.futures
+import io
 import mimetypes
+import multiprocessing
 import os
 from pathlib import Path
 try:
@@ -19,73 +24,160 @@ import signal
 import traceback
 import zipfile
 
-from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
-from fastapi.staticfiles import StaticFiles
-from starlette.requests import Request
-from starlette.responses import RedirectResponse
-from starlette.websockets import WebSocket
-from ariadne.asgi import GraphQL as AriadneGraphQL
-from ariadne.asgi.handlers import GraphQLTransportWSHandler
-
 from rime import Rime
-from rime.graphql import load_schema, QueryContext
 from rime.config import Config
 
 
-def rime_background_task_entrypoint(config, cmd, args):
-    """
-    This is started in a separate process. It performs a single task and then exits.
+# The Rime configuration and event loop in background task worker processes. Set by _bg_worker_init().
+_bg_worker_config = None
+_bg_worker_loop = None
 
-    'config' is the Rime configuration.
+# The worker's Rime, created by its first task and reused by the rest.
+_bg_worker_rime = None
+
+
+def _bg_worker_init(config):
+    """
+    Runs once in each background task worker process when it starts.
     """
-    aio_loop = asyncio.new_event_loop()
+    global _bg_worker_config, _bg_worker_loop
+    _bg_worker_config = config
 
     # Reset signal behaviour; see https://github.com/encode/uvicorn/issues/548#issuecomment-1157082729
     signal.set_wakeup_fd(-1) # don't send the signal into shared socket
     signal.signal(signal.SIGTERM, signal.SIG_DFL) # reset signal handlers to default
     signal.signal(signal.SIGINT, signal.SIG_DFL) # reset signal handlers to default
 
-    asyncio.set_event_loop(aio_loop)
+    _bg_worker_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(_bg_worker_loop)
 
-    async def bg_enqueue_bg_call(rime, fn, *args, on_complete_fn=None):
-        # Background RIME also needs a 'run in background' task, but we just run in fg here.
-        exc = None
 
-        try:
-            result = aio_loop.run_until_complete(fn(rime, *args))
-        except Exception as e:
-            traceback.print_exc()
-            result = None
-            exc = e
+async def _bg_enqueue_bg_call(rime, fn, *args, on_complete_fn=None):
+    # Background RIME also needs a 'run in background' task, but we just run in fg here.
+    exc = None
 
-        if on_complete_fn is not None:
-            await on_complete_fn(rime, result, exc)
+    try:
+        result = _bg_worker_loop.run_until_complete(fn(rime, *args))
+    except Exception as e:
+        traceback.print_exc()
+        result = None
+        exc = e
+
+    if on_complete_fn is not None:
+        await on_complete_fn(rime, result, exc)
 
-    async def run_cmd_in_background_rime():
-        bg_rime = Rime.create(config, bg_enqueue_bg_call)
-        return await cmd(bg_rime, *args)
 
-    result = aio_loop.run_until_complete(run_cmd_in_background_rime())
-    aio_loop.close()
+def _create_bg_task_executor(config):
+    """
+    Create the pool of processes which run background tasks.
 
-    return result
+    On Linux the workers are started from a forkserver which has already imported RIME and its GraphQL layer (and so
+    Ariadne), so new workers don't pay the import cost and don't inherit the server's threads and open databases.
+    """
+    if sys.platform.startswith('linux'):
+        mp_context = multiprocessing.get_context('forkserver')
+        mp_context.set_forkserver_preload(['rime', 'rime.graphql'])
+    else:
+        mp_context = None
+
+    return concurrent.futures.ProcessPoolExecutor(
+        mp_context=mp_context,
+        initializer=_bg_worker_init,
+        initargs=(config,),
+    )
+
+
+def rime_background_task_entrypoint(cmd, args):
+    """
+    This runs in a background task worker process and performs a single task.
+
+    The worker's Rime, which uses the configuration the worker was initialised with, is kept between tasks so that
+    its session, plugins and devices aren't set up again each time. Devices may have been added, removed or
+    replaced by the server since the last task, so they are rescanned first.
+    """
+    global _bg_worker_rime
+
+    if _bg_worker_rime is None:
+        _bg_worker_rime = Rime.create(_bg_worker_config, _bg_enqueue_bg_call, async_loop=_bg_worker_loop)
+    else:
+        _bg_worker_rime.rescan_devices()
+
+    return _bg_worker_loop.run_until_complete(cmd(_bg_worker_rime, *args))
+
+
+# Size of the chunks in which files that can't be sent straight from disk are read and sent.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def _iter_chunks(f):
+    """
+    Yield the contents of binary file-like object 'f' in chunks, closing it afterwards.
+
+    Iterating over the file itself would yield lines, which for binary data can be anything from a byte to the
+    whole file.
+    """
+    with f:
+        while chunk := f.read(STREAM_CHUNK_SIZE):
+            yield chunk
+
+
+def _plain_file_pathname(media_data):
+    """
+    Return the host pathname of the media if it is a plain file, otherwise None.
+    """
+    if media_data.syspath is not None and os.path.isfile(media_data.syspath):
+        return media_data.syspath
+
+    handle = media_data.handle
+    if isinstance(handle, io.BufferedReader) and isinstance(handle.raw, io.FileIO) \
+            and isinstance(handle.name, str):
+        return handle.name
+
+    return None
 
 
 class ZippedStaticFiles:
     def __init__(self, zip_pathname):
+        # FastAPI is imported when the app is created rather than with this module. Keep what requests need here so
+        # that each one doesn't import it again.
+        from fastapi import HTTPException
+        from fastapi.responses import StreamingResponse
+        self._http_exception = HTTPException
+        self._streaming_response = StreamingResponse
+
         self.zf = zipfile.ZipFile(zip_pathname, 'r')
 
+        # The frontend bundle doesn't change while we're running, so look up each file's member and MIME type once.
+        self._members = {
+            info.filename: (info, mimetypes.guess_type(info.filename)[0])
+            for info in self.zf.infolist()
+            if not info.is_dir()
+        }
+
     def __call__(self, path):
         if path == '':
             path = 'index.html'
 
-        mime_type = mimetypes.guess_type(path)[0]
-        return StreamingResponse(self.zf.open(path), media_type=mime_type)
+        try:
+            info, mime_type = self._members[path]
+        except KeyError:
+            raise self._http_exception(status_code=404)
+
+        return self._streaming_response(_iter_chunks(self.zf.open(info)), media_type=mime_type)
 
 
 def create_app(config_pathname=None, frontend_zip_pathname=None, frontend_hostport=None, schema_pathname=None):
+    from fastapi import FastAPI
+    from fastapi.middleware.cors import CORSMiddleware
+    from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+    from starlette.concurrency import run_in_threadpool
+    from starlette.requests import Request
+    from starlette.responses import RedirectResponse
+    from starlette.websockets import WebSocket
+    from ariadne.asgi import GraphQL as AriadneGraphQL
+    from ariadne.asgi.handlers import GraphQLTransportWSHandler
+    from rime.graphql import load_schema, QueryContext
+
     if frontend_hostport and frontend_zip_pathname:
         # frontend_zip_pathname is for production deploys; frontend_hostport is for dev.
         raise ValueError("Please supply either frontend_zip_pathname or frontend_hostport, not both.")
@@ -111,13 +203,13 @@ def create_app(config_pathname=None, frontend_zip_pathname=None, frontend_hostpo
 
     rime_config = Config.from_file(config_pathname)
 
-    bg_task_executor = concurrent.futures.ProcessPoolExecutor()
+    bg_task_executor = _create_bg_task_executor(rime_config)
 
     async def enqueue_background_task(rime, cmd, *args, on_complete_fn=None):
         assert isinstance(rime, Rime)
 
         # Start a new process to run the background task.
-        future = bg_task_executor.submit(rime_background_task_entrypoint, rime_config, cmd, args)
+        future = bg_task_executor.submit(rime_background_task_entrypoint, cmd, args)
 
         afuture = asyncio.wrap_future(future)
 
@@ -163,9 +255,16 @@ def create_app(config_pathname=None, frontend_zip_pathname=None, frontend_hostpo
     @app.get("/media/{media_id:path}")
     async def handle_media(media_id: str):
         media_id = urllib.parse.unquote(media_id)
-        media_data =  rime.get_media(media_id)
+        # Finding and opening the media may query databases or read from a zip, so keep it off the event loop.
+        media_data = await run_in_threadpool(rime.get_media, media_id)
+
+        pathname = _plain_file_pathname(media_data)
+        if pathname is not None:
+            # A plain file: let Starlette send it from disk rather than streaming it through the handle.
+            media_data.handle.close()
+            return FileResponse(pathname, media_type=media_data.mime_type)
 
-        response = StreamingResponse(media_data.handle, media_type=media_data.mime_type)
+        response = StreamingResponse(_iter_chunks(media_data.handle), media_type=media_data.mime_type)
         response.headers['Content-Length'] = str(media_data.length)
         return response
 
@@ -5,9 +5,15 @@
 """
 Thin wrapper around pypika with methods to perform subsetting and helpers in sqlite databases.
 """
+from collections import OrderedDict
+from contextlib import contextmanager
+from copy import copy
+import functools
 import itertools
+import os
 import re
 import sys
+import threading
 from typing import Any, Union
 
 import pypika
@@ -15,7 +21,12 @@ import pypika.utils
 import pypika.queries
 from pypika.terms import Term, Field, Star, Function, ArithmeticExpression
 from pypika.queries import QueryException
-import sqlite3
+try:
+    # pysqlite3 bundles a much newer SQLite than Python is often built with. It's optional: without it, the standard
+    # library's sqlite3 is used. Other modules should take sqlite3 from here so that exceptions and Row match.
+    from pysqlite3 import dbapi2 as sqlite3
+except ImportError:
+    import sqlite3
 
 Table = pypika.Table
 # Query is defined below (we use a custom one)
@@ -24,8 +35,25 @@ Parameter = pypika.Parameter
 Connection = sqlite3.Connection
 
 
+@functools.lru_cache(maxsize=256)
+def _compile_regexp(pattern):
+    return re.compile(pattern)
+
+
 def _sqlite3_regexp_search(pattern, input):
-    return bool(re.search(pattern, input))
+    # REGEXP is called for every row, nearly always with the same pattern.
+    return _compile_regexp(pattern).search(input) is not None
+
+
+# Applied to every connection. Most of what we open is read-only, so these are about reading: a larger page cache,
+# memory-mapped I/O and in-memory temporary tables. The journal mode and synchronous setting are left alone, as WAL
+# mode is recorded in the database file itself and we create and modify device databases as well as our own
+# (MetadataDb sets them for its cache).
+_CONNECTION_PRAGMAS = (
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-65536',  # 64 MiB
+    'PRAGMA mmap_size=268435456',  # 256 MiB
+)
 
 
 def sqlite3_connect(db_path, uri=False):
@@ -33,33 +61,110 @@ def sqlite3_connect(db_path, uri=False):
     Connect to an sqlite3 database and add support for regular expression matching.
     If db_path is a file: URI, then set uri=True
     """
-    # We current do not, but in future may, support caching connections across threads.
-    check_same_thread = False
-
     if uri is False and db_path.startswith('file:'):
         raise ValueError(f"Supplied a URI-looking db_path of {db_path} but uri is False")
 
+    return _sqlite3_connect(db_path, uri)
+
+
+def _sqlite3_connect(db_path, uri):
+    # Read-only connections are shared between threads; see sqlite3_connect_filename().
+    check_same_thread = False
+
     try:
         conn = sqlite3.connect(db_path, uri=uri, check_same_thread=check_same_thread)
-        conn.create_function('REGEXP', 2, _sqlite3_regexp_search)
+        conn.create_function('REGEXP', 2, _sqlite3_regexp_search, deterministic=True)
     except sqlite3.OperationalError as e:
         print(f"Error connecting to database {db_path} (uri={uri}): {e}", file=sys.stderr)
         raise
 
+    try:
+        for pragma in _CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+    except sqlite3.DatabaseError:
+        # Some of these read the database header. If it isn't a database, leave that to be reported when it's used.
+        pass
+
     return conn
 
 
-def sqlite3_connect_filename(path, read_only=True):
+# Read-only connections are shared rather than opened afresh for each query, which keeps SQLite's page cache warm.
+# They're opened with immutable=1, so a connection is only reused while its file is unchanged.
+_READ_ONLY_POOL_SIZE = 32
+_read_only_pool = OrderedDict()  # absolute pathname -> ((st_ino, st_size, st_mtime_ns), Connection)
+_read_only_pool_lock = threading.Lock()
+
+
+def _is_open(conn):
+    try:
+        conn.total_changes
+    except sqlite3.ProgrammingError:
+        return False
+
+    return True
+
+
+def sqlite3_connect_filename(path, read_only=True, shared=True):
+    """
+    Connect to the sqlite3 database at 'path'. Read-only connections may be shared, so they mustn't be closed or
+    otherwise changed by the caller; pass shared=False for a read-only connection of the caller's own.
+    """
+    path = os.fspath(path)
+    if not read_only or not shared:
+        return _sqlite3_connect_filename(path, read_only)
+
+    try:
+        stat_val = os.stat(path)
+    except OSError:
+        # Let SQLite report the problem as usual.
+        return _sqlite3_connect_filename(path, read_only)
+
+    key = os.path.abspath(path)
+    identity = (stat_val.st_ino, stat_val.st_size, stat_val.st_mtime_ns)
+
+    with _read_only_pool_lock:
+        entry = _read_only_pool.get(key)
+        if entry is not None and entry[0] == identity and _is_open(entry[1]):
+            _read_only_pool.move_to_end(key)
+            return entry[1]
+
+    conn = _sqlite3_connect_filename(path, read_only)
+
+    with _read_only_pool_lock:
+        _read_only_pool[key] = (identity, conn)
+        _read_only_pool.move_to_end(key)
+        while len(_read_only_pool) > _READ_ONLY_POOL_SIZE:
+            # Anything still using an evicted connection keeps it open until it's done.
+            _read_only_pool.popitem(last=False)
+
+    return conn
+
+
+def sqlite3_close_pooled_connections(dirname):
+    """
+    Close the shared read-only connections to databases beneath 'dirname', e.g. before deleting it.
+    """
+    prefix = os.path.join(os.path.abspath(dirname), '')
+
+    with _read_only_pool_lock:
+        for key in [key for key in _read_only_pool if key.startswith(prefix)]:
+            _read_only_pool.pop(key)[1].close()
+
+
+_WINDOWS_DRIVE_RE = re.compile(r'^[a-zA-Z]:')
+
+
+def _sqlite3_connect_filename(path, read_only):
     if sys.platform == 'win32':
         # If it's an absolute path, we need to add a leading slash to make it a URI
-        if re.match(r'^[a-zA-Z]:', path):
+        if _WINDOWS_DRIVE_RE.match(path):
             path = '/' + path
 
         # Also, switch to forward slashes.
         path = path.replace('\\', '/')
 
     params = "?mode=ro&immutable=1" if read_only else ""
-    return sqlite3_connect(f"file://{path}{params}", uri=True)
+    return _sqlite3_connect(f"file://{path}{params}", uri=True)
 
 
 def get_field_indices(query):
@@ -75,25 +180,56 @@ class SqliteQuery(pypika.queries.Query):
 
 class SqliteQueryBuilder(pypika.queries.QueryBuilder):
     # Most of the following copied from PostgresQueryBuilder in pypika.
-    def __init__(self):
-        super().__init__()
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
         self._returns = []
         self._return_star = False
+        # The tables a RETURNING term may refer to, worked out once per returning() call.
+        self._returning_tables = None
+
+    def __copy__(self) -> "SqliteQueryBuilder":
+        newone = super().__copy__()
+        newone._returns = copy(self._returns)
+        return newone
+
+    @contextmanager
+    def mutable(self):
+        """
+        Within the context, builder methods modify this query in place rather than copying it first.
+        """
+        was_immutable = self.immutable
+        self.immutable = False
+        try:
+            yield self
+        finally:
+            self.immutable = was_immutable
 
     def _validate_returning_term(self, term: Term) -> None:
-        for field in term.fields_():
-            if not any([self._insert_table, self._update_table, self._delete_from]):
-                raise QueryException("Returning can't be used in this query")
-
-            table_is_insert_or_update_table = field.table in {self._insert_table, self._update_table}
-            join_tables = set(itertools.chain.from_iterable([j.criterion.tables_ for j in self._joins]))
-            join_and_base_tables = set(self._from) | join_tables
-            table_not_base_or_join = bool(term.tables_ - join_and_base_tables)
-            if not table_is_insert_or_update_table and table_not_base_or_join:
+        fields = term.fields_()
+        if not fields:
+            return
+
+        if not any([self._insert_table, self._update_table, self._delete_from]):
+            raise QueryException("Returning can't be used in this query")
+
+        if self._returning_tables is None:
+            if self._joins:
+                join_tables = itertools.chain.from_iterable(j.criterion.tables_ for j in self._joins)
+                self._returning_tables = frozenset(self._from).union(join_tables)
+            else:
+                # The usual case: a single-table INSERT, UPDATE or DELETE.
+                self._returning_tables = frozenset(self._from)
+
+        insert_or_update_tables = {self._insert_table, self._update_table}
+        table_not_base_or_join = bool(term.tables_ - self._returning_tables)
+        for field in fields:
+            if field.table not in insert_or_update_tables and table_not_base_or_join:
                 raise QueryException("You can't return from other tables")
 
     @pypika.utils.builder
     def returning(self, *terms: Any) -> "SqliteQueryBuilder":  # type: ignore
+        # The query's tables don't change while terms are added, but may have since the last call.
+        self._returning_tables = None
         for term in terms:
             if isinstance(term, Field):
                 self._return_field(term)
@@ -28,19 +28,17 @@ def _copy_table(src_conn, dst_conn, table_name, add_where_clause_fn):
     dst_conn.execute(sql)
 
     table = Table(table_name)
-    select_query = Query.from_(table) \
-        .select('*')
-
-    if add_where_clause_fn is not None:
-        select_query = add_where_clause_fn(select_query, table)
-
-    # Recreate each row.
-    parameters = None
-    for row in src_conn.execute(select_query.get_sql()):
-        if parameters is None:
-            parameters = [Parameter('?') for _ in row]
-        insert_query = Query.into(table_name).insert(*parameters)
-        dst_conn.execute(insert_query.get_sql(), row)
+    select_query = Query.from_(table)
+    with select_query.mutable():
+        select_query.select('*')
+
+        if add_where_clause_fn is not None:
+            select_query = add_where_clause_fn(select_query, table)
+
+    # Recreate each row, streaming them from the source query into a single executemany().
+    rows = src_conn.execute(select_query.get_sql())
+    insert_query = Query.into(table_name).insert(*[Parameter('?') for _ in rows.description])
+    dst_conn.executemany(insert_query.get_sql(), rows)
 
 
 SubsetFillOption = Enum('SubsetFillOption', ('MINIMAL', 'UNUSED_TABLES', 'UNUSED_DBS_AND_TABLES'))
@@ -69,6 +69,12 @@ if [ ! -f .venv/bin/activate ]; then
 	# in which gcc etc are available. If it fails, just warn the user.
 	pip install fastpbkdf2 || echo "*** WARNING: fastpbkdf2 failed to install. This will make the server slower with encrypted filesystems.***"
 
+	# Likewise deflate (libdeflate bindings), which speeds up unzipping zipped filesystems.
+	pip install deflate || echo "*** WARNING: deflate failed to install. This will make the server slower to unzip zipped filesystems.***"
+
+	# And pysqlite3-binary, a recent SQLite. Wheels are only available for some platforms.
+	pip install pysqlite3-binary || echo "*** WARNING: pysqlite3-binary failed to install. Python's own SQLite will be used instead.***"
+
 	# Install AI requirements unless explicitly asked not to.
 	if [ $NO_AI -eq 0 ]; then
 		pip install -r rime/plugins/ai_requirements.txt
@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+from rime.filesystem.direntry import DirEntry
+from rime.filesystem.metadata import MetadataDb
+
+
+@pytest.fixture(scope="module", autouse=True)
+def rime_server():
+    " The metadata DB is used directly, so these tests don't need a RIME server. "
+    yield
+
+
+def _make_file(tmp_path, name, contents):
+    pathname = tmp_path / name
+    pathname.write_bytes(contents)
+    return os.stat(pathname)
+
+
+def test_dir_entries_round_trip(tmp_path):
+    text_stat = _make_file(tmp_path, 'a.txt', b'hello')
+    image_stat = _make_file(tmp_path, 'b.jpg', b'\xff\xd8\xff' + b'\0' * 100)
+    db = MetadataDb(str(tmp_path / 'db' / '_rime_settings.db'))
+
+    db.add_dir_entries_for_pathnames([
+        DirEntry(path='sdcard/a.txt', stat_val=text_stat, mime_type='text/plain'),
+        DirEntry(path='sdcard/b.jpg', stat_val=image_stat, mime_type='image/jpeg'),
+    ])
+    entries = {entry.path: entry for entry in db.get_dir_entries_for_pathnames(
+        ['sdcard/a.txt', 'sdcard/b.jpg', 'sdcard/missing.txt'])}
+
+    assert sorted(entries) == ['sdcard/a.txt', 'sdcard/b.jpg']
+    for path, stat_val, mime_type in (('sdcard/a.txt', text_stat, 'text/plain'),
+                                      ('sdcard/b.jpg', image_stat, 'image/jpeg')):
+        assert entries[path].mime_type == mime_type
+        assert entries[path].stat_val.st_size == stat_val.st_size
+        assert entries[path].stat_val.st_mtime == stat_val.st_mtime
+        assert entries[path].is_file()
+
+
+def test_old_schema_drops_cache_but_keeps_settings(tmp_path):
+    db_pathname = str(tmp_path / 'db' / '_rime_settings.db')
+    stat_val = _make_file(tmp_path, 'a.txt', b'hello')
+
+    db = MetadataDb(db_pathname)
+    db.set_locked(True)
+    db.add_dir_entries_for_pathnames([DirEntry(path='sdcard/a.txt', stat_val=stat_val, mime_type='text/plain')])
+    db.db.execute('PRAGMA user_version=1')
+    db.db.close()
+
+    db = MetadataDb(db_pathname)
+
+    assert db.get_dir_entries_for_pathnames(['sdcard/a.txt']) == []
+    assert db.is_locked()
+
+
+def test_cached_mime_types(tmp_path):
+    stat_vals = [_make_file(tmp_path, f'{i}.txt', b'hello') for i in range(3)]
+    db = MetadataDb(str(tmp_path / 'db' / '_rime_settings.db'))
+
+    entries = [DirEntry(path=f'sdcard/{i}.txt', stat_val=stat_val, mime_type='text/plain')
+               for i, stat_val in enumerate(stat_vals[:2])]
+    db.add_dir_entries_for_pathnames(entries, mime_cache_entries=entries)
+    changed_stat = _make_file(tmp_path, '1.txt', b'changed')
+
+    assert db.get_cached_mime_types(stat_vals[:1] + [changed_stat] + stat_vals[2:]) == {
+        (stat_vals[0].st_dev, stat_vals[0].st_ino): 'text/plain',
+    }
+    assert db.get_cached_mime_types([]) == {}